@@ -5,36 +5,88 @@ from toykoin.core.utils import hash256
 from dataclasses import dataclass
 from typing import List, Tuple
 
+HEADER_SIZE = 76
+
 
-@dataclass
 class BlockHeader:
-    previous_pow: str = ""
-    merkle_root: str = ""
-    nonce: int = 0
+    __slots__ = ("previous_pow", "merkle_root", "nonce", "_cache")
+
+    def __init__(self, previous_pow=b"", merkle_root=b"", nonce=0):
+        self.previous_pow = previous_pow
+        self.merkle_root = merkle_root
+        self.nonce = nonce
+
+    def __setattr__(self, name, value):
+        # hashes are stored as raw bytes, hex is accepted for convenience
+        if isinstance(value, str):
+            value = bytes.fromhex(value)
+        super().__setattr__(name, value)
+        # assigning a field drops the memoized serialization and pow
+        if name != "_cache":
+            super().__setattr__("_cache", None)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (
+            self.previous_pow == other.previous_pow
+            and self.merkle_root == other.merkle_root
+            and self.nonce == other.nonce
+        )
+
+    def __repr__(self):
+        return (
+            f"BlockHeader(previous_pow={self.previous_pow.hex()!r}, "
+            f"merkle_root={self.merkle_root.hex()!r}, nonce={self.nonce!r})"
+        )
+
+    # a sealed header memoizes its serialization and pow, assigning any of its
+    # fields unseals it
+    def seal(self):
+        if self._cache is None:
+            serialized = self.serialize()
+            self._cache = {"serialized": serialized, "hash": hash256(serialized)}
+        return self
+
+    def unseal(self):
+        self._cache = None
+        return self
+
+    @property
+    def sealed(self):
+        return self._cache is not None
 
     def serialize(self):
-        out = bytes.fromhex(self.previous_pow)
-        out += bytes.fromhex(self.merkle_root)
+        if self._cache is not None:
+            return self._cache["serialized"]
+        out = self.previous_pow + self.merkle_root
         out += self.nonce.to_bytes(12, "big")
         return out
 
     @classmethod
     def deserialize(cls, data):
-        previous_pow = data[:32].hex()
-        merkle_root = data[32:64].hex()
+        data = memoryview(data)
+        previous_pow = bytes(data[:32])
+        merkle_root = bytes(data[32:64])
         nonce = int.from_bytes(data[64:76], "big")
         return BlockHeader(previous_pow, merkle_root, nonce)
 
     def is_valid(self):
-        if len(self.previous_pow) != 64:
+        if len(self.previous_pow) != 32:
             return False
-        if len(self.merkle_root) != 64:
+        if len(self.merkle_root) != 32:
             return False
         return True
 
+    @property
+    def hash(self):
+        if self._cache is not None:
+            return self._cache["hash"]
+        return hash256(self.serialize())
+
     @property
     def pow(self):
-        return hash256(self.serialize()).hex()
+        return self.hash.hex()
 
 
 @dataclass
@@ -42,6 +94,24 @@ class Block:
     header: BlockHeader
     transactions: List[Tx]
 
+    # sealing a block seals its header and transactions, so that the pow and
+    # every txid are computed only once while the block is being connected
+    def seal(self):
+        self.header.seal()
+        for tx in self.transactions:
+            tx.seal()
+        return self
+
+    def unseal(self):
+        self.header.unseal()
+        for tx in self.transactions:
+            tx.unseal()
+        return self
+
+    @property
+    def sealed(self):
+        return self.header.sealed and all(tx.sealed for tx in self.transactions)
+
     def serialize(self):
         out = self.header.serialize()
         out += len(self.transactions).to_bytes(2, "big")
@@ -52,14 +122,15 @@ class Block:
 
     @classmethod
     def deserialize(cls, data):
-        header = BlockHeader.deserialize(data[:76])
+        data = memoryview(data)
+        header = BlockHeader.deserialize(data[:HEADER_SIZE])
         transactions = []
-        transaction_count = int.from_bytes(data[76:78], "big")
-        data = data[78:]
-        for i in range(transaction_count):
-            tx_size = int.from_bytes(data[:2], "big")
-            transactions.append(Tx.deserialize(data[2 : 2 + tx_size]))
-            data = data[2 + tx_size :]
+        transaction_count = int.from_bytes(data[HEADER_SIZE : HEADER_SIZE + 2], "big")
+        i = HEADER_SIZE + 2
+        for _ in range(transaction_count):
+            tx_size = int.from_bytes(data[i : i + 2], "big")
+            transactions.append(Tx.deserialize(data[i + 2 : i + 2 + tx_size]))
+            i += 2 + tx_size
         return Block(header, transactions)
 
     def is_valid(self):
@@ -75,7 +146,7 @@ class Block:
             or not self.transactions[0].is_valid()
         ):
             return False
-        outpoints = []
+        outpoints = set()
         for tx in self.transactions[1:]:
             if tx.is_coinbase() or not tx.is_valid():
                 return False
@@ -83,57 +154,57 @@ class Block:
                 if txin.prevout in outpoints:
                     return False
                 else:
-                    outpoints.append(txin.prevout)
+                    outpoints.add(txin.prevout)
         return True
 
 
+# ids are the raw 34 bytes outpoint keys used by the UTXO set
 @dataclass
 class RevBlock:
-    pow: str
-    old_txout: List[Tuple[str, TxOut]]
-    removable: List[str]
+    pow: bytes
+    old_txout: List[Tuple[bytes, TxOut]]
+    removable: List[bytes]
 
     def serialize(self):
-        out = bytes.fromhex(self.pow)
+        out = self.pow
         out += len(self.old_txout).to_bytes(2, "big")
         for txout in self.old_txout:
-            out += bytes.fromhex(txout[0])
+            out += txout[0]
             tx_bytes = txout[1].serialize()
             out += len(tx_bytes).to_bytes(2, "big") + tx_bytes
         out += len(self.removable).to_bytes(2, "big")
         for txout in self.removable:
-            out += bytes.fromhex(txout)
+            out += txout
         return out
 
     @classmethod
     def deserialize(cls, data):
-        pow = data[:32].hex()
-        data = data[32:]
+        data = memoryview(data)
+        pow = bytes(data[:32])
         old_txout = []
         removable = []
-        len_txout_list = int.from_bytes(data[:2], "big")
-        data = data[2:]
-        for x in range(len_txout_list):
-            id = data[:34].hex()
-            data = data[34:]
-            txout_size = int.from_bytes(data[:2], "big")
-            txout = TxOut.deserialize(data[2 : 2 + txout_size])
+        len_txout_list = int.from_bytes(data[32:34], "big")
+        i = 34
+        for _ in range(len_txout_list):
+            id = bytes(data[i : i + 34])
+            txout_size = int.from_bytes(data[i + 34 : i + 36], "big")
+            txout = TxOut.deserialize(data[i + 36 : i + 36 + txout_size])
             old_txout.append([id, txout])
-            data = data[2 + txout_size :]
+            i += 36 + txout_size
 
-        len_removable = int.from_bytes(data[:2], "big")
-        data = data[2:]
-        for x in range(len_removable):
-            removable.append(data[:34].hex())
-            data = data[34:]
+        len_removable = int.from_bytes(data[i : i + 2], "big")
+        i += 2
+        for _ in range(len_removable):
+            removable.append(bytes(data[i : i + 34]))
+            i += 34
         return RevBlock(pow, old_txout, removable)
 
     def is_valid(self):
-        if len(self.pow) != 64:
+        if len(self.pow) != 32:
             return False
         for txout in self.old_txout:
             if not txout[1].is_valid():
                 return False
-            if OutPoint.deserialize(bytes.fromhex(txout[0])).is_coinbase():
+            if OutPoint.deserialize(txout[0]).is_coinbase():
                 return False
         return True
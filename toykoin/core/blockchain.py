@@ -1,125 +1,839 @@
-from toykoin.core.utxo import UTXOSet
-from toykoin.core.block import RevBlock
-from toykoin.core.pow import work_from_chain
+from toykoin.core.utxo import UTXOSet, UTXO_CACHE_SIZE
+from toykoin.core.block import Block, RevBlock
+from toykoin.core.pow import block_work
+from toykoin.core.storage import SegmentStore
+from toykoin.core.tx import OutPoint
+from toykoin.core.utils import (
+    apply_durability_profile,
+    PROFILES,
+    get_schema_version,
+    set_schema_version,
+    table_exists,
+    legacy_id,
+)
 
+from collections import OrderedDict
 import os
 import sqlite3
+import time
 
+# bytes of the big endian cumulative chainwork, it leaves room over 2 ** 256
+CHAINWORK_SIZE = 40
+# with the "auto" profile the chain is downloaded with the "ibd" profile while
+# it is more than IBD_DISTANCE blocks behind the best known height
+IBD_DISTANCE = 100
+# the blocks and undo data a pruned node always keeps, to handle reorgs
+MIN_BLOCKS_TO_KEEP = 288
+# blocks whose parent is unknown are kept until it arrives, within these bounds
+ORPHAN_MAX_COUNT = 100
+ORPHAN_MAX_SIZE = 32 * 2 ** 20
+# header links kept while the assume_valid block is not known, the oldest ones
+# are dropped first
+ASSUME_VALID_MAX_HEADERS = 2 ** 18
 
+
+# The scripts of assume_valid and of its ancestors are not executed, every
+# other check is still done. A block is known to be an ancestor once the
+# headers linking it to assume_valid have been seen, see add_headers.
+# check_all_scripts disables the shortcut
 class BlockchainConfig:
-    pass
+    def __init__(self, assume_valid=None, check_all_scripts=False):
+        if isinstance(assume_valid, str):
+            assume_valid = bytes.fromhex(assume_valid)
+        self.assume_valid = assume_valid
+        self.check_all_scripts = check_all_scripts
+
+
+class BlockIndexEntry:
+    __slots__ = (
+        "pow",
+        "previous_pow",
+        "height",
+        "chainwork",
+        "position",
+        "rev_position",
+    )
+
+    def __init__(self, pow, previous_pow, height, chainwork):
+        self.pow = pow
+        self.previous_pow = previous_pow
+        self.height = height
+        self.chainwork = chainwork
+        # (file, offset, length) of the block and of its undo data, if stored
+        self.position = None
+        self.rev_position = None
+
+    def __repr__(self):
+        return (
+            f"BlockIndexEntry(pow={self.pow.hex()!r}, height={self.height!r}, "
+            f"chainwork={self.chainwork!r})"
+        )
+
+    # the header row as stored in the header table
+    @property
+    def row(self):
+        return (self.pow, self.previous_pow, self.height)
+
+
+# In-memory copy of the header table, the blocks of the best chain by pow and
+# by height, and by the segment file of their block and undo data. Changes are
+# journaled until commit(), rollback() undoes them
+class BlockIndex:
+    def __init__(self):
+        self.entries = {}
+        self.chain = []
+        self.journal = []
+        self.files = {}  # (attribute, file) -> entries, the lowest first
+
+    @classmethod
+    def load(cls, cursor):
+        index = cls()
+        cursor.execute(
+            "SELECT pow, previous_pow, chainwork, block_file, block_offset, "
+            "block_length, rev_file, rev_offset, rev_length FROM header ORDER BY id"
+        )
+        for row in cursor.fetchall():
+            position = row[3:6] if row[3] is not None else None
+            rev_position = row[6:9] if row[6] is not None else None
+            index.push(
+                row[0], row[1], int.from_bytes(row[2], "big"), position, rev_position
+            )
+        index.commit()
+        return index
+
+    @property
+    def tip(self):
+        return self.chain[-1] if self.chain else None
+
+    def __len__(self):
+        return len(self.chain)
+
+    def get(self, pow):
+        return self.entries.get(pow)
+
+    # the entries of a file are kept sorted by height: an entry is always added
+    # as the tip and only the tip is removed
+    def _add_to_files(self, entry):
+        for attribute in ["position", "rev_position"]:
+            position = getattr(entry, attribute)
+            if position is not None:
+                self.files.setdefault((attribute, position[0]), []).append(entry)
+
+    def _remove_from_files(self, entry):
+        for attribute in ["position", "rev_position"]:
+            position = getattr(entry, attribute)
+            if position is not None:
+                entries = self.files[(attribute, position[0])]
+                entries.pop()
+                if not entries:
+                    del self.files[(attribute, position[0])]
+
+    # the entries of the best chain whose attribute points to file
+    def file_entries(self, attribute, file):
+        return self.files.get((attribute, file), [])
+
+    def push(self, pow, previous_pow, chainwork, position=None, rev_position=None):
+        entry = BlockIndexEntry(pow, previous_pow, len(self.chain), chainwork)
+        entry.position = position
+        entry.rev_position = rev_position
+        self.entries[pow] = entry
+        self.chain.append(entry)
+        self._add_to_files(entry)
+        self.journal.append(None)
+        return entry
+
+    def pop(self):
+        entry = self.chain.pop()
+        del self.entries[entry.pow]
+        self._remove_from_files(entry)
+        self.journal.append(entry)
+        return entry
+
+    # forgets the positions pointing to a pruned file
+    def prune_file(self, attribute, file):
+        for entry in self.files.pop((attribute, file), []):
+            setattr(entry, attribute, None)
+
+    def commit(self):
+        self.journal = []
+
+    # undoes the changes journaled after the first mark ones
+    def rollback(self, mark=0):
+        for entry in reversed(self.journal[mark:]):
+            if entry is None:  # undo a push
+                entry = self.chain.pop()
+                del self.entries[entry.pow]
+                self._remove_from_files(entry)
+            else:
+                self.entries[entry.pow] = entry
+                self.chain.append(entry)
+                self._add_to_files(entry)
+        del self.journal[mark:]
 
 
+# Blocks received before their parent, by pow and by previous_pow. The oldest
+# ones are evicted when there are more than max_count or they take more than
+# max_size serialized bytes
+class OrphanPool:
+    def __init__(self, max_count=ORPHAN_MAX_COUNT, max_size=ORPHAN_MAX_SIZE):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.blocks = OrderedDict()  # pow -> (block, size), the oldest first
+        self.children = {}  # previous_pow -> {pow: None}, the first seen first
+        self.size = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __contains__(self, pow):
+        return pow in self.blocks
+
+    def add(self, block):
+        pow = block.header.hash
+        size = len(block.serialize())
+        if pow in self.blocks or size > self.max_size:
+            return
+        self.blocks[pow] = (block, size)
+        self.children.setdefault(block.header.previous_pow, {})[pow] = None
+        self.size += size
+        while len(self.blocks) > self.max_count or self.size > self.max_size:
+            self.remove(next(iter(self.blocks)))
+
+    def remove(self, pow):
+        block, size = self.blocks.pop(pow)
+        siblings = self.children[block.header.previous_pow]
+        del siblings[pow]
+        if not siblings:
+            del self.children[block.header.previous_pow]
+        self.size -= size
+        return block
+
+    # removes the descendants of pow, returned as one chain for each leaf. The
+    # chains are in the order their blocks were received, so that the first
+    # seen of two branches with the same work is connected first
+    def pop_descendants(self, pow):
+        chains = []
+        stack = [(pow, [])]
+        while stack:
+            parent, chain = stack.pop()
+            children = self.children.get(parent)
+            if not children:
+                if chain:
+                    chains.append(chain)
+                continue
+            for child in reversed(list(children)):  # the first one is popped first
+                stack.append((child, chain + [self.remove(child)]))
+        return chains
+
+
+# The headers, the coins and the best block marker are kept in the same
+# chainstate database, so they are always committed together. profile is the
+# name of one of PROFILES, or "auto" to switch between "ibd" and "safe"
+# according to the distance from the best known height. A pruned node deletes
+# the oldest segment files while they take more than prune_size bytes, or
+# while their blocks are deeper than prune_depth, but it always keeps the last
+# MIN_BLOCKS_TO_KEEP blocks. Blocks whose parent is unknown wait in the orphan
+# pool and are connected together once it is. cache_size is the memory budget
+# of the coin cache, in bytes
 class Blockchain:
-    def __init__(self, name="regtest"):
+    def __init__(
+        self,
+        name="regtest",
+        script_workers=0,
+        batch_signatures=False,
+        profile="auto",
+        prune_size=0,
+        prune_depth=0,
+        config=None,
+        cache_size=UTXO_CACHE_SIZE,
+    ):
         self.base_dir = os.path.join(os.path.expanduser("~"), ".toykoin", name)
         os.makedirs(self.base_dir, exist_ok=True)
-        os.makedirs(os.path.join(self.base_dir, "blocks"), exist_ok=True)
-        os.makedirs(os.path.join(self.base_dir, "rev"), exist_ok=True)
+        self.blocks = SegmentStore(os.path.join(self.base_dir, "blocks"), "blk")
+        self.rev_blocks = SegmentStore(os.path.join(self.base_dir, "rev"), "rev")
 
-        self.__utxo_set = UTXOSet(self.base_dir)
         self.db = sqlite3.connect(os.path.join(self.base_dir, "chainstate.sqlite"))
         self.cursor = self.db.cursor()
-        try:  # initializing db
-            self.cursor.execute("CREATE TABLE header (pow, previous_pow, id)")
-        except:
-            pass
+        self.profile_name = profile
+        self.profile = None
+        self.best_known_height = None
+        self.pending_blocks = 0  # added since the last commit
+        self.last_commit = time.monotonic()
+        self.prune_size = prune_size
+        self.prune_depth = prune_depth
+        self.config = config or BlockchainConfig()
+        self.orphans = OrphanPool()
+        self.headers = {}  # pow -> previous_pow, see ASSUME_VALID_MAX_HEADERS
+        self.assumed_valid = set()  # ancestors of assume_valid not connected yet
+        self.assume_valid_bottom = self.config.assume_valid  # its parent is unknown
+        self._set_profile(PROFILES.get(profile, PROFILES["safe"]))
+        self._upgrade_db()
+        self.cursor.execute("SELECT height FROM prune_height")
+        row = self.cursor.fetchone()
+        self.prune_height = row[0] if row else -1  # no data is missing above it
+        self.__utxo_set = UTXOSet(
+            cache_size=cache_size,
+            script_workers=script_workers,
+            batch_signatures=batch_signatures,
+            db=self.db,
+        )
+        merged = self._merge_utxo_db()
+        self.index = BlockIndex.load(self.cursor)
+        self._check_best_block(merged)
+        self._set_profile(self._wanted_profile())
+
+    def close(self):
+        if self.db.in_transaction:
+            self.commit()
+        self.__utxo_set.close()
+        self.blocks.close()
+        self.rev_blocks.close()
+        self.db.close()
+
+    # creates the tables, or migrates them from an older schema, in a single
+    # transaction
+    def _upgrade_db(self):
+        self.cursor.execute("BEGIN")
+        version = get_schema_version(self.cursor, "header")
+        if version < 1 and not table_exists(self.cursor, "header"):
+            # a new database starts from the current schema
+            self.cursor.execute(
+                "CREATE TABLE header (pow BLOB PRIMARY KEY, "
+                "previous_pow BLOB NOT NULL, id INTEGER NOT NULL, "
+                "chainwork BLOB NOT NULL, block_file INTEGER, block_offset INTEGER, "
+                "block_length INTEGER, rev_file INTEGER, rev_offset INTEGER, "
+                "rev_length INTEGER) WITHOUT ROWID"
+            )
+            self.cursor.execute("CREATE UNIQUE INDEX header_id ON header (id)")
+            set_schema_version(self.cursor, "header", 3)
+            version = 3
+        if version < 1:  # untyped table with hex hashes and no index
+            self.cursor.execute("ALTER TABLE header RENAME TO header_v0")
+            self.cursor.execute(
+                "CREATE TABLE header (pow BLOB PRIMARY KEY, "
+                "previous_pow BLOB NOT NULL, id INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            self.cursor.execute("CREATE UNIQUE INDEX header_id ON header (id)")
+            self.cursor.execute("SELECT pow, previous_pow, id FROM header_v0")
+            headers = [
+                (legacy_id(pow), legacy_id(previous_pow), id)
+                for pow, previous_pow, id in self.cursor.fetchall()
+            ]
+            self.cursor.executemany("INSERT INTO header VALUES (?, ?, ?)", headers)
+            self.cursor.execute("DROP TABLE header_v0")
+            set_schema_version(self.cursor, "header", 1)
+            version = 1
+        if version < 2:  # backfills the cumulative chainwork of each header
+            self.cursor.execute("ALTER TABLE header RENAME TO header_v1")
+            self.cursor.execute("DROP INDEX header_id")
+            self.cursor.execute(
+                "CREATE TABLE header (pow BLOB PRIMARY KEY, "
+                "previous_pow BLOB NOT NULL, id INTEGER NOT NULL, "
+                "chainwork BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self.cursor.execute("CREATE UNIQUE INDEX header_id ON header (id)")
+            self.cursor.execute(
+                "SELECT pow, previous_pow, id FROM header_v1 ORDER BY id"
+            )
+            headers = []
+            chainwork = 0
+            for pow, previous_pow, id in self.cursor.fetchall():
+                chainwork += block_work(pow)
+                headers.append(
+                    (pow, previous_pow, id, chainwork.to_bytes(CHAINWORK_SIZE, "big"))
+                )
+            self.cursor.executemany("INSERT INTO header VALUES (?, ?, ?, ?)", headers)
+            self.cursor.execute("DROP TABLE header_v1")
+            set_schema_version(self.cursor, "header", 2)
+        legacy_files = []
+        if version < 3:  # blocks and undo data are stored in segment files
+            for column in ["block", "rev"]:
+                for field in ["file", "offset", "length"]:
+                    self.cursor.execute(
+                        f"ALTER TABLE header ADD COLUMN {column}_{field} INTEGER"
+                    )
+            legacy_files = self._convert_block_files()
+            set_schema_version(self.cursor, "header", 3)
+        if get_schema_version(self.cursor, "best_block") < 1:
+            self.cursor.execute(
+                "CREATE TABLE best_block (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "pow BLOB NOT NULL)"
+            )
+            set_schema_version(self.cursor, "best_block", 1)
+        if get_schema_version(self.cursor, "prune_height") < 1:
+            self.cursor.execute(
+                "CREATE TABLE prune_height (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                "height INTEGER NOT NULL)"
+            )
+            set_schema_version(self.cursor, "prune_height", 1)
+        if get_schema_version(self.cursor, "reindex_position") < 1:
+            self.cursor.execute(
+                "CREATE TABLE reindex_position (height INTEGER PRIMARY KEY, "
+                "file INTEGER NOT NULL, offset INTEGER NOT NULL, "
+                "length INTEGER NOT NULL)"
+            )
+            set_schema_version(self.cursor, "reindex_position", 1)
+        self.db.commit()
+        for filename in legacy_files:
+            os.remove(filename)
+
+    # the utxo table used to be kept in its own utxo_set.sqlite, it is moved
+    # to the chainstate database once
+    def _merge_utxo_db(self):
+        filename = os.path.join(self.base_dir, "utxo_set.sqlite")
+        if not os.path.exists(filename):
+            return False
+        UTXOSet(self.base_dir).close()  # brings it to the current schema
+        self.cursor.execute("ATTACH DATABASE ? AS legacy", (filename,))
+        try:
+            self.cursor.execute("BEGIN")
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO utxo SELECT id, value, script FROM legacy.utxo"
+            )
+            self.db.commit()
+        finally:
+            self.cursor.execute("DETACH DATABASE legacy")
+        os.remove(filename)
+        return True
+
+    # The marker records the tip the coins were committed with. A marker behind
+    # the tip is repaired by connecting the missing blocks to the utxo set
+    # again, unless they have been pruned. A marker that is not in the best
+    # chain cannot be repaired. The marker is missing after the merge of the
+    # utxo database, which is checked by _check_merged_utxo, and in a header
+    # table migrated without its coins, where it is set to the tip
+    def _check_best_block(self, merged=False):
+        self.cursor.execute("SELECT pow FROM best_block")
+        row = self.cursor.fetchone()
+        marker = row[0] if row else None
+        tip = self.index.tip
+        if marker == (tip.pow if tip else None) and not merged:
+            return
+        legacy_files = []
+        if marker is not None:
+            entry = self.index.get(marker)
+            if entry is None:
+                raise Exception("the best block marker is not in the best chain")
+            entries = self.index.chain[entry.height + 1 :]
+            if any(entry.position is None for entry in entries):
+                raise Exception("the blocks to connect again have been pruned")
+            for entry in entries:
+                self.__utxo_set.add_block(self.read_block(entry.pow))
+        if merged:
+            legacy_files = self._check_merged_utxo()
+        self.commit()
+        for filename in legacy_files:
+            os.remove(filename)
+
+    # whether every output of the coinbase of block is in the utxo set
+    def _has_coinbase_outputs(self, block):
+        coinbase = block.transactions[0]
+        ids = [
+            OutPoint(coinbase.hash, i).serialize() for i in range(len(coinbase.outputs))
+        ]
+        return len(self.__utxo_set.get_utxos(ids)) == len(ids)
+
+    # The old utxo_set.sqlite was committed before the headers, so its coins can
+    # include the block after the tip. The files of that block were written
+    # before both commits and are left among the legacy files: the block is
+    # reversed with them, which are returned to be removed. The coinbase
+    # outputs of the tip are then unspent, otherwise the coins cannot be trusted
+    def _check_merged_utxo(self):
+        tip = self.index.tip
+        tip_pow = tip.pow if tip else b"\x00" * 32
+        legacy_files = []
+        for filename in os.listdir(self.blocks.directory):
+            if not filename.endswith(".block"):
+                continue
+            block_file = os.path.join(self.blocks.directory, filename)
+            rev_file = os.path.join(
+                self.rev_blocks.directory, filename[: -len(".block")] + ".rev"
+            )
+            with open(block_file, "rb") as f:
+                block = Block.deserialize(f.read())
+            if block.header.previous_pow != tip_pow:
+                continue
+            if not self._has_coinbase_outputs(block) or not os.path.exists(rev_file):
+                continue
+            with open(rev_file, "rb") as f:
+                self.__utxo_set.reverse_block(RevBlock.deserialize(f.read()))
+            legacy_files += [block_file, rev_file]
+        if tip is not None:
+            block = self.read_block(tip.pow)
+            if block is None:
+                raise Exception("the tip is needed to check the merged coins")
+            if not self._has_coinbase_outputs(block):
+                raise Exception("the merged coins do not match the tip, reindex")
+        return legacy_files
+
+    # moves the blocks and undo data stored one per file in blocks/<pow>.block
+    # and rev/<pow>.rev to the segment files, returns the files to remove
+    def _convert_block_files(self):
+        legacy_files = []
+        self.cursor.execute("SELECT pow FROM header ORDER BY id")
+        for (pow,) in self.cursor.fetchall():
+            for store, column, extension in [
+                (self.blocks, "block", ".block"),
+                (self.rev_blocks, "rev", ".rev"),
+            ]:
+                filename = os.path.join(store.directory, pow.hex() + extension)
+                if not os.path.exists(filename):
+                    continue
+                with open(filename, "rb") as f:
+                    position = store.append(f.read())
+                self.cursor.execute(
+                    f"UPDATE header SET {column}_file = ?, {column}_offset = ?, "
+                    f"{column}_length = ? WHERE pow = ?",
+                    position + (pow,),
+                )
+                legacy_files.append(filename)
+        self.blocks.flush()
+        self.rev_blocks.flush()
+        return legacy_files
 
     def get_utxo_set(self):
         return self.__utxo_set
 
     def get_block(self, pow):
-        self.cursor.execute("SELECT * FROM header WHERE pow = ?", (pow,))
-        block = self.cursor.fetchall()
-        return block[0] if block else None
+        entry = self.index.get(pow)
+        return entry.row if entry else None
+
+    # the total work of the chain ending with the pow block, 0 if it is unknown
+    def get_chainwork(self, pow):
+        entry = self.index.get(pow)
+        return entry.chainwork if entry else 0
 
+    # the last n blocks of the chain, starting from the tip
     def get_last_blocks(self, n=1):
+        if not self.index.chain:
+            return [[None, None, -1]]
+        return [entry.row for entry in reversed(self.index.chain[-n:])]
+
+    # the block with the given pow in the best chain, None if it is not stored
+    def read_block(self, pow):
+        entry = self.index.get(pow)
+        if entry is None or entry.position is None:
+            return None
+        return Block.deserialize(self.blocks.read(entry.position))
+
+    # whether the data of a block of the best chain has been pruned
+    def is_pruned(self, pow):
+        entry = self.index.get(pow)
+        return entry is not None and entry.position is None
+
+    # the files that can be pruned as (highest height, store, attribute of the
+    # position in the entries, header column, file), the lowest first. A file
+    # without blocks of the best chain only holds disconnected ones
+    def _prune_candidates(self):
+        candidates = []
+        for store, attribute, column in [
+            (self.blocks, "position", "block"),
+            (self.rev_blocks, "rev_position", "rev"),
+        ]:
+            for file in store.files():
+                if file == store.file:
+                    continue
+                entries = self.index.file_entries(attribute, file)
+                height = entries[-1].height if entries else -1
+                candidates.append((height, column, file, store, attribute))
+        candidates.sort(key=lambda candidate: candidate[:3])
+        return candidates
+
+    # deletes segment files once the blocks pointing to them are committed
+    # without their positions
+    def _prune(self):
+        tip = self.index.tip
+        if not (self.prune_size or self.prune_depth) or tip is None:
+            return
+        total = self.blocks.size() + self.rev_blocks.size()
+        pruned = []
+        for height, column, file, store, attribute in self._prune_candidates():
+            if height > tip.height - MIN_BLOCKS_TO_KEEP:
+                break
+            deep = self.prune_depth and height <= tip.height - self.prune_depth
+            if not deep and not (self.prune_size and total > self.prune_size):
+                break
+            total -= store.file_size(file)
+            self.cursor.execute(
+                f"UPDATE header SET {column}_file = NULL, {column}_offset = NULL, "
+                f"{column}_length = NULL WHERE {column}_file = ?",
+                (file,),
+            )
+            pruned.append((store, attribute, file))
+            self.prune_height = max(self.prune_height, height)
+        if not pruned:
+            return
         self.cursor.execute(
-            "SELECT * FROM header WHERE id > (SELECT MAX(id) FROM header) -?", (n,)
+            "INSERT OR REPLACE INTO prune_height VALUES (0, ?)", (self.prune_height,)
         )
-        last_pow = self.cursor.fetchall()
-        if not last_pow:
-            return [[None, None, -1]]
+        self.db.commit()
+        for store, attribute, file in pruned:
+            self.index.prune_file(attribute, file)
+            store.remove(file)
+
+    def _wanted_profile(self):
+        if self.profile_name != "auto":
+            return PROFILES[self.profile_name]
+        height = self.index.tip.height if self.index.tip else -1
+        known = self.best_known_height
+        if known is not None and known - height > IBD_DISTANCE:
+            return PROFILES["ibd"]
+        return PROFILES["safe"]
+
+    # the pragmas cannot be changed inside a transaction
+    def _set_profile(self, profile):
+        if profile is not self.profile and not self.db.in_transaction:
+            apply_durability_profile(self.cursor, profile)
+            self.profile = profile
+
+    # commits the pending blocks and switches to the profile called name
+    def set_profile(self, name):
+        if self.db.in_transaction:
+            self.commit()
+        self.profile_name = name
+        self._set_profile(self._wanted_profile())
+
+    # forgets every header and coin, the segment files are left untouched
+    # reindex_positions are the block positions of the best chain being
+    # rebuilt, they are kept until end_reindex() so that a reindex that did not
+    # finish can be started again
+    def reset_chainstate(self, reindex_positions=()):
+        if self.db.in_transaction:
+            self.commit()
+        self.cursor.execute("BEGIN")
+        for table in ["header", "utxo", "best_block", "prune_height"]:
+            self.cursor.execute(f"DELETE FROM {table}")
+        self.cursor.execute("DELETE FROM reindex_position")
+        self.cursor.executemany(
+            "INSERT INTO reindex_position VALUES (?, ?, ?, ?)",
+            [(height, *position) for height, position in enumerate(reindex_positions)],
+        )
+        self.db.commit()
+        self.__utxo_set.cache.clear()
+        self.index = BlockIndex()
+        self.prune_height = -1
+
+    # the positions given to reset_chainstate, empty once the reindex ended
+    def get_reindex_positions(self):
+        self.cursor.execute(
+            "SELECT file, offset, length FROM reindex_position ORDER BY height"
+        )
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def end_reindex(self):
+        if self.db.in_transaction:
+            self.commit()
+        self.cursor.execute("BEGIN")
+        self.cursor.execute("DELETE FROM reindex_position")
+        self.db.commit()
+
+    # records the links between headers, so that the ancestors of the
+    # assume_valid block are known before being connected
+    def add_headers(self, headers):
+        config = self.config
+        if config.assume_valid is None or config.check_all_scripts:
+            return
+        if self.index.get(config.assume_valid):
+            return
+        for header in headers:
+            self.headers[header.hash] = header.previous_pow
+        pow = self.assume_valid_bottom
+        while pow in self.headers:
+            self.assumed_valid.add(pow)
+            pow = self.headers.pop(pow)
+        self.assume_valid_bottom = pow
+        while len(self.headers) > ASSUME_VALID_MAX_HEADERS:
+            del self.headers[next(iter(self.headers))]
+
+    # the height of the best chain announced by the peers
+    def set_best_known_height(self, height):
+        if self.best_known_height is None or height > self.best_known_height:
+            self.best_known_height = height
+        self._set_profile(self._wanted_profile())
+
+    # commits the pending blocks if enough of them accumulated, if the last
+    # commit is too old or if the profile has to change
+    def _commit_if_due(self):
+        profile = self.profile
+        if not self.pending_blocks:
+            return
+        if (
+            self.pending_blocks >= profile.commit_blocks
+            or time.monotonic() - self.last_commit >= profile.commit_seconds
+            or self._wanted_profile() is not profile
+        ):
+            try:
+                self.commit()
+            except:
+                self.rollback()
+
+    # commits headers, coins and best block marker at once. The headers point
+    # to the segment files, so they are flushed first
+    def commit(self):
+        self.blocks.flush(self.profile.sync_files)
+        self.rev_blocks.flush(self.profile.sync_files)
+        tip = self.index.tip
+        if tip:
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO best_block VALUES (0, ?)", (tip.pow,)
+            )
         else:
-            return last_pow
+            self.cursor.execute("DELETE FROM best_block")
+        self.__utxo_set.commit()  # it commits the shared connection
+        self.index.commit()
+        self.pending_blocks = 0
+        self.last_commit = time.monotonic()
+        self._prune()
+        self._set_profile(self._wanted_profile())
 
-    def _add_block(self, block):
+    def rollback(self):
+        self.__utxo_set.rollback()  # it rolls back the shared connection
+        self.index.rollback()
+
+    def _add_block(self, block, checked=False):
+        self.pending_blocks += 1
+        block.seal()
         previous_pow = block.header.previous_pow
-        if previous_pow != "00" * 32 and previous_pow != self.get_last_blocks()[0][0]:
+        tip = self.index.tip
+        if previous_pow != b"\x00" * 32 and (tip is None or previous_pow != tip.pow):
             raise Exception
-        reverse_block = self.__utxo_set.add_block(block)
+        check_scripts = block.header.hash not in self.assumed_valid
+        reverse_block = self.__utxo_set.add_block(block, check_scripts, checked)
+        chainwork = self.get_chainwork(previous_pow) + block_work(block.header.hash)
+        position = self.blocks.append(block.serialize())
+        rev_position = self.rev_blocks.append(reverse_block.serialize())
+        entry = self.index.push(
+            block.header.hash, previous_pow, chainwork, position, rev_position
+        )
+        if entry.pow == self.config.assume_valid:  # the next ones are verified
+            self.headers.clear()
+            self.assumed_valid.clear()
         self.cursor.execute(
-            "INSERT INTO header VALUES (?, ?, ?)",
+            "INSERT INTO header VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
             (
-                block.header.pow,
-                block.header.previous_pow,
-                self.get_last_blocks()[0][2] + 1,
-            ),
+                entry.pow,
+                entry.previous_pow,
+                entry.height,
+                chainwork.to_bytes(CHAINWORK_SIZE, "big"),
+            )
+            + entry.position
+            + entry.rev_position,
         )
-        filename = os.path.join(self.base_dir, "blocks", block.header.pow + ".block")
-        with open(filename, "wb") as f:
-            f.write(block.serialize())
-        filename = os.path.join(self.base_dir, "rev", block.header.pow + ".rev")
-        with open(filename, "wb") as f:
-            f.write(reverse_block.serialize())
         return reverse_block
 
     def _reverse_block(self, rev_block):
-        if rev_block.pow != self.get_last_blocks()[0][0]:
+        tip = self.index.tip
+        if tip is None or rev_block.pow != tip.pow:
             raise Exception
         self.__utxo_set.reverse_block(rev_block)
         self.cursor.execute("DELETE FROM header WHERE pow = ?", (rev_block.pow,))
+        self.index.pop()
 
-    # it does not raise exceptions, it return True if the blockchain pow been changed
-    def add_blocks(self, blocks):
+    # runs function(*args) in a savepoint, its changes are undone if it
+    # raises. Returns whether it succeeded
+    def _atomic(self, function, *args):
+        if not self.db.in_transaction:  # releasing the savepoint must not commit
+            self.cursor.execute("BEGIN")
+        self.cursor.execute("SAVEPOINT atomic")
+        mark = len(self.index.journal)
+        try:
+            function(*args)
+            self.__utxo_set.flush()
+            self.cursor.execute("RELEASE atomic")
+            return True
+        except:
+            self.__utxo_set.discard()
+            self.cursor.execute("ROLLBACK TO atomic")
+            self.cursor.execute("RELEASE atomic")
+            self.index.rollback(mark)
+            return False
+
+    # disconnects the entries, ordered from the tip, with their undo records
+    # read upfront
+    def _disconnect(self, entries):
+        if any(entry.rev_position is None for entry in entries):
+            raise Exception  # the undo data has been pruned
+        rev_blocks = [
+            RevBlock.deserialize(self.rev_blocks.read(entry.rev_position))
+            for entry in entries
+        ]
+        self.__utxo_set.reverse_blocks(rev_blocks)
+        self.cursor.executemany(
+            "DELETE FROM header WHERE pow = ?", [(entry.pow,) for entry in entries]
+        )
+        for entry in entries:
+            self.index.pop()
+
+    # If blocks fork the best chain, the chain is reorganized only if the
+    # branch can end with more work than the current one: this is known from
+    # the headers alone, before anything is disconnected. The blocks of the
+    # branch are then connected until it has more work, they are appended to
+    # connected. Changes stay in the coin cache until the whole reorg succeeds
+    def _reorganize(self, blocks, connected, checked=False):
+        fork = self.index.get(blocks[0].header.previous_pow)
+        tip = self.index.tip
+        if not fork or tip.height == fork.height:  # nothing to disconnect
+            return
+        if fork.height < self.prune_height:
+            raise Exception  # the undo data of the fork has been pruned
+        branch_work = fork.chainwork
+        previous_pow = fork.pow
+        for block in blocks:
+            if block.header.previous_pow != previous_pow:
+                break
+            branch_work += block_work(block.header.hash)
+            previous_pow = block.header.hash
+        if branch_work <= tip.chainwork:
+            return  # dry run, the branch cannot become the best chain
+
+        self._disconnect(self.index.chain[: fork.height : -1])
+        for block in blocks:
+            self._add_block(block, checked)
+            connected.append(block)
+            if self.index.tip.chainwork > tip.chainwork:
+                return  # already in best chain
+        raise Exception
+
+    # it does not raise exceptions, it return True if the blockchain pow been changed.
+    # checked blocks already passed Block.is_valid, it is not run again
+    def add_blocks(self, blocks, checked=False):
 
         last_block = self.get_last_blocks()
 
+        for block in blocks:  # pow and txids are then computed once per block
+            block.seal()
+        self.add_headers([block.header for block in blocks])
+
         for i, block in enumerate(blocks):
-            if not self.get_block(block.header.pow):  # first new block
+            if not self.get_block(block.header.hash):  # first new block
                 blocks = blocks[i:]
                 break
 
-        try:  # tries to add enough blocks to be in the best chain
-
-            last_valid_block = self.get_block(blocks[0].header.previous_pow)
-            if last_valid_block:  # if it is not the first block
-                last_valid_index = self.get_block(last_valid_block[0])[2]
-                last_index = self.get_last_blocks()[0][2]
-                if last_index - last_valid_index > 0:
-                    reverse_blocks = self.get_last_blocks(last_index - last_valid_index)
-                    for rev_block in reverse_blocks:
-                        filename = os.path.join(
-                            self.base_dir, "rev", rev_block[0] + ".rev"
-                        )
-                        with open(filename, "rb") as f:
-                            rev_block = RevBlock.deserialize(f.read())
-                        self._reverse_block(rev_block)
-
-                    previous_work = work_from_chain([rev[0] for rev in reverse_blocks])
-                    current_chain = []
-                    blocks = (i for i in blocks)  # change to iterator
-                    for block in blocks:
-                        self._add_block(block)
-                        current_chain.append(block.header.pow)
-                        if work_from_chain(current_chain) > previous_work:
-                            break  # already in best chain
-
-            self.__utxo_set.db.commit()
-            self.db.commit()
-        except:
-            self.__utxo_set.db.rollback()
-            self.db.rollback()
+        if not blocks:
+            return False
+
+        previous_pow = blocks[0].header.previous_pow
+        if previous_pow != b"\x00" * 32 and not self.index.get(previous_pow):
+            for block in blocks:
+                self.orphans.add(block)
             return False
 
+        # tries to add enough blocks to be in the best chain
+        connected = []
+        if not self._atomic(self._reorganize, blocks, connected, checked):
+            return False
+        self._commit_if_due()
+
+        # a block that cannot be added is rolled back on its own
+        for block in blocks[len(connected) :]:
+            if self._atomic(self._add_block, block, checked):
+                self._commit_if_due()
+
+        # the orphans waiting for these blocks, each chain in one batch
         for block in blocks:
-            try:
-                self._add_block(block)
-                self.__utxo_set.db.commit()
-                self.db.commit()
-            except:
-                self.__utxo_set.db.rollback()
-                self.db.rollback()
+            if self.index.get(block.header.hash):
+                for chain in self.orphans.pop_descendants(block.header.hash):
+                    self.add_blocks(chain)
 
         if last_block == self.get_last_blocks():
             return False
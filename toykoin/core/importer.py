@@ -0,0 +1,290 @@
+from toykoin.core.block import Block, BlockHeader, HEADER_SIZE
+from toykoin.core.blockchain import Blockchain, BlockchainConfig
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import queue
+import threading
+import time
+
+# blocks connected by each call to add_blocks
+IMPORT_BATCH_SIZE = 100
+# blocks waiting between two stages of the pipeline
+QUEUE_SIZE = 256
+
+
+# the blocks of an import file are framed by their length
+def write_block_file(path, blocks):
+    with open(path, "wb") as f:
+        for block in blocks:
+            data = block.serialize()
+            f.write(len(data).to_bytes(4, "big") + data)
+
+
+def read_block_file(path):
+    with open(path, "rb") as f:
+        while True:
+            size = f.read(4)
+            if len(size) < 4:
+                return
+            yield f.read(int.from_bytes(size, "big"))
+
+
+# only the headers are read, the rest of each block is skipped
+def read_block_file_headers(path):
+    with open(path, "rb") as f:
+        while True:
+            size = f.read(4)
+            if len(size) < 4:
+                return
+            size = int.from_bytes(size, "big")
+            yield BlockHeader.deserialize(f.read(HEADER_SIZE))
+            f.seek(size - HEADER_SIZE, 1)
+
+
+# the serialized blocks of the best chain, from the genesis
+def export_blocks(blockchain, path):
+    with open(path, "wb") as f:
+        for entry in blockchain.index.chain:
+            if entry.position is None:
+                raise Exception  # pruned
+            data = blockchain.blocks.read(entry.position)
+            f.write(len(data).to_bytes(4, "big") + data)
+
+
+# the checks that do not need the chainstate, run on the worker pool
+def check_block(data):
+    return Block.deserialize(data).is_valid()
+
+
+class ImportProgress:
+    def __init__(self):
+        self.read = 0
+        self.checked = 0
+        self.connected = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.queues = (0, 0)  # blocks waiting to be checked and connected
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):  # connected blocks per second
+        return self.connected / self.elapsed if self.elapsed else 0
+
+    def __repr__(self):
+        return (
+            f"ImportProgress(read={self.read}, checked={self.checked}, "
+            f"connected={self.connected}, queues={self.queues}, "
+            f"rate={self.rate:.1f} blocks/s, "
+            f"throughput={self.bytes / max(self.elapsed, 1e-9) / 2 ** 20:.2f} MiB/s)"
+        )
+
+
+# puts item in a bounded queue, unless the pipeline is stopped
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# the next item of a queue, or None once the pipeline is stopped
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+# Streams serialized blocks through three stages connected by bounded queues:
+# a thread reads and deserializes them, a thread sends them to the contextless
+# checks on a pool of workers processes (inline if workers is 0) and the
+# caller thread connects them in batches with the "ibd" profile. progress is
+# called with an ImportProgress every report_interval seconds and at the end.
+# The import stops at the first invalid block, the progress is returned. An
+# exception raised by a stage, e.g. by source, is raised again once the blocks
+# before it are connected. headers are given to Blockchain.add_headers before the import starts
+def import_blocks(
+    blockchain,
+    source,
+    workers=0,
+    progress=None,
+    report_interval=1,
+    check=True,
+    headers=(),
+):
+    blockchain.add_headers(headers)
+    stats = ImportProgress()
+    stop = threading.Event()
+    deserialized = queue.Queue(QUEUE_SIZE)
+    checked = queue.Queue(QUEUE_SIZE)
+    executor = ProcessPoolExecutor(workers) if workers and check else None
+    errors = []
+
+    # a block that cannot be deserialized ends the import
+    def read():
+        try:
+            for data in source:
+                try:
+                    block = Block.deserialize(data)
+                except:
+                    break
+                stats.read += 1
+                stats.bytes += len(data)
+                if not _put(deserialized, (data, block), stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            _put(deserialized, None, stop)
+
+    def submit():
+        try:
+            while True:
+                item = _get(deserialized, stop)
+                if item is None:
+                    return
+                data, block = item
+                if executor:
+                    result = executor.submit(check_block, data)
+                else:
+                    try:
+                        result = not check or block.is_valid()
+                    except:
+                        result = False
+                if not _put(checked, (block, result), stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            _put(checked, None, stop)
+
+    stages = [threading.Thread(target=read), threading.Thread(target=submit)]
+    profile_name = blockchain.profile_name
+    blockchain.set_profile("ibd")
+    try:
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        batch = []
+        last_report = time.monotonic()
+        while True:
+            try:
+                item = checked.get(timeout=0.1)
+            except queue.Empty:
+                if any(stage.is_alive() for stage in stages):
+                    continue
+                item = None  # the stages ended without their sentinel
+            if item is not None:
+                block, result = item
+                if not isinstance(result, bool):
+                    try:
+                        result = result.result()
+                    except:
+                        result = False
+                if not result:
+                    item = None
+                else:
+                    stats.checked += 1
+                    batch.append(block)
+            if batch and (item is None or len(batch) >= IMPORT_BATCH_SIZE):
+                # the contextless checks are not run again
+                blockchain.add_blocks(batch, checked=True)
+                for block in batch:
+                    if blockchain.index.get(block.header.hash) is None:
+                        item = None  # it could not be connected
+                        break
+                    stats.connected += 1
+                batch = []
+            stats.queues = (deserialized.qsize(), checked.qsize())
+            if progress and time.monotonic() - last_report >= report_interval:
+                progress(stats)
+                last_report = time.monotonic()
+            if item is None:
+                break
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+        if executor:
+            executor.shutdown()
+        blockchain.set_profile(profile_name)
+    if errors:
+        raise errors[0]
+    if progress:
+        progress(stats)
+    return stats
+
+
+# Rebuilds the chainstate by connecting again the blocks of the best chain.
+# They are read from the current segment files and written to new ones, the
+# old files are deleted once every block has been connected again, otherwise
+# they are kept and an exception is raised. The positions of the blocks are
+# saved with the reset of the chainstate, the next reindex starts again from
+# them if this one did not finish. A pruned node cannot be reindexed
+def reindex(blockchain, workers=0, progress=None):
+    positions = blockchain.get_reindex_positions()
+    if not positions:
+        if blockchain.prune_height >= 0:
+            raise Exception
+        positions = [entry.position for entry in blockchain.index.chain]
+        if any(position is None for position in positions):
+            raise Exception
+    blockchain.reset_chainstate(positions)
+    old_files = []
+    for store in (blockchain.blocks, blockchain.rev_blocks):
+        old_files.append((store, store.files()))
+        store.start_file()
+
+    headers = [
+        BlockHeader.deserialize(blockchain.blocks.read((file, offset, HEADER_SIZE)))
+        for file, offset, _ in positions
+    ]
+    source = (blockchain.blocks.read(position) for position in positions)
+    # the blocks were already checked when they were first connected
+    stats = import_blocks(
+        blockchain, source, workers, progress, check=False, headers=headers
+    )
+    if stats.connected != len(positions):
+        raise Exception(
+            f"reindex stopped after {stats.connected} of {len(positions)} blocks, "
+            "the old segment files are kept"
+        )
+    blockchain.end_reindex()
+    for store, files in old_files:
+        for file in files:
+            store.remove(file)
+    return stats
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="import or reindex blocks")
+    parser.add_argument("--name", default="regtest")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--import-file", help="file written by export_blocks")
+    parser.add_argument("--assume-valid", help="hex pow of the assumed valid block")
+    parser.add_argument("--check-all-scripts", action="store_true")
+    args = parser.parse_args(args)
+    config = BlockchainConfig(args.assume_valid, args.check_all_scripts)
+    blockchain = Blockchain(args.name, config=config)
+    try:
+        if args.import_file:
+            source = read_block_file(args.import_file)
+            headers = read_block_file_headers(args.import_file)
+            import_blocks(blockchain, source, args.workers, print, headers=headers)
+        else:
+            reindex(blockchain, args.workers, print)
+    finally:
+        blockchain.close()
+
+
+if __name__ == "__main__":
+    main()
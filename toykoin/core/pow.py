@@ -1,17 +1,133 @@
-from copy import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from hashlib import sha256
+import time
 
+NONCE_SIZE = 12
+MAX_NONCE = 2 ** (8 * NONCE_SIZE)
 
-def calculate_nonce(header, target):
-    header = copy(header)
-    while True:
-        header.nonce += 1
-        pow = 2 ** 256 / int(header.pow, 16)
-        if pow > target:
-            return header.nonce
+
+# a pow is valid if 2 ** 256 / pow > target, that is if its digest as a big
+# endian integer is at most the returned bound. The target can be a float
+def target_bound(target):
+    target = Fraction(target)
+    bound = (2 ** 256 * target.denominator - 1) // target.numerator
+    return min(bound, 2 ** 256 - 1).to_bytes(32, "big")
+
+
+# tries the nonces in [start, stop), the sha256 state of the 64 bytes that
+# precede the nonce is computed once. Returns the first valid nonce, if any,
+# and the number of nonces tried
+def search_nonces(prefix, start, stop, bound):
+    midstate = sha256(prefix)
+    for nonce in range(start, stop):
+        state = midstate.copy()
+        state.update(nonce.to_bytes(NONCE_SIZE, "big"))
+        if sha256(state.digest()).digest() <= bound:
+            return nonce, nonce - start + 1
+    return None, stop - start
+
+
+# Searches the nonce space in chunks of chunk_size nonces. With workers > 0 the
+# chunks are searched in parallel on a pool of that many processes. The search
+# stops between two chunks if the cancel event is set, e.g. when a new tip
+# arrives. hashes and elapsed cover every search made by the miner
+class Miner:
+    def __init__(self, workers=0, chunk_size=2 ** 14):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = None
+        self.hashes = 0
+        self.elapsed = 0
+
+    @property
+    def hashrate(self):
+        if not self.elapsed:
+            return 0
+        return self.hashes / self.elapsed
+
+    def get_executor(self):
+        if self.workers and not self.executor:
+            self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _chunks(self, start):
+        while start < MAX_NONCE:
+            stop = min(start + self.chunk_size, MAX_NONCE)
+            yield start, stop
+            start = stop
+
+    # returns the first valid nonce after header.nonce, None if cancelled or if
+    # the nonce space is exhausted
+    def mine(self, header, target, cancel=None):
+        prefix = header.serialize()[:-NONCE_SIZE]
+        bound = target_bound(target)
+        chunks = self._chunks(header.nonce + 1)
+        begin = time.perf_counter()
+        try:
+            executor = self.get_executor()
+            if executor is None:
+                return self._mine_serial(prefix, bound, chunks, cancel)
+            return self._mine_parallel(executor, prefix, bound, chunks, cancel)
+        finally:
+            self.elapsed += time.perf_counter() - begin
+
+    def _mine_serial(self, prefix, bound, chunks, cancel):
+        for start, stop in chunks:
+            if cancel is not None and cancel.is_set():
+                return None
+            nonce, hashes = search_nonces(prefix, start, stop, bound)
+            self.hashes += hashes
+            if nonce is not None:
+                return nonce
+        return None
+
+    # the chunks are collected in order, so the nonce is the same found by
+    # _mine_serial. One chunk more than the workers is queued to keep them busy
+    def _mine_parallel(self, executor, prefix, bound, chunks, cancel):
+        pending = deque()
+        try:
+            for start, stop in chunks:
+                pending.append(
+                    executor.submit(search_nonces, prefix, start, stop, bound)
+                )
+                if len(pending) <= self.workers:
+                    continue
+                nonce, hashes = pending.popleft().result()
+                self.hashes += hashes
+                if nonce is not None:
+                    return nonce
+                if cancel is not None and cancel.is_set():
+                    return None
+            while pending:
+                nonce, hashes = pending.popleft().result()
+                self.hashes += hashes
+                if nonce is not None:
+                    return nonce
+            return None
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def calculate_nonce(header, target, miner=None):
+    if miner is None:
+        miner = Miner()
+    return miner.mine(header, target)
+
+
+# the expected number of hashes needed to find pow, exact integer arithmetic
+def block_work(pow):
+    if isinstance(pow, str):
+        pow = bytes.fromhex(pow)
+    return 2 ** 256 // int.from_bytes(pow, "big")
 
 
 def work_from_chain(chain):
-    pow = 0
-    for block in chain:
-        pow += 2 ** 256 / int(block, 16)
-    return pow
+    return sum(block_work(pow) for pow in chain)
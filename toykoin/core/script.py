@@ -1,12 +1,30 @@
-from dataclasses import dataclass, field
-from typing import List
 from btclib.utils import hash256
+from btclib.curve import secp256k1
 from btclib import ssa
 
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import as_completed
+import os
+import random
+import threading
+
 
-@dataclass
 class Script:
-    expressions: List[str] = field(default_factory=list)
+    __slots__ = ("expressions",)
+
+    def __init__(self, expressions=None):
+        if expressions is None:
+            expressions = []
+        self.expressions = expressions
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.expressions == other.expressions
+
+    def __repr__(self):
+        return f"Script(expressions={self.expressions!r})"
 
     def __add__(self, other):
         expressions = self.expressions + other.expressions
@@ -23,14 +41,18 @@ class Script:
 
     @classmethod
     def deserialize(cls, data):
+        # walk a memoryview with an offset, only the expression payloads are copied
+        data = memoryview(data)
         expressions = []
-        while data:
-            expression_len = int.from_bytes(data[:2], "big")
-            data = data[2:]
-            var = data[0]
-            func = data[1]
-            expression_data = data[2:expression_len]
-            data = data[expression_len:]
+        i = 0
+        while i < len(data):
+            expression_len = int.from_bytes(data[i : i + 2], "big")
+            var = data[i + 2]
+            func = data[i + 3]
+            if expression_len == 0:  # it would never advance
+                raise Exception
+            expression_data = bytes(data[i + 4 : i + 2 + expression_len])
+            i += 2 + expression_len
             expressions.append([var, func, expression_data])
         return cls(expressions=expressions)
 
@@ -45,58 +67,453 @@ class Script:
     def is_valid(self):
         return len(self.serialize()) < 256 ** 2
 
-    def execute(self, memory):
-        return _execute_script(self, memory)
+    # if signatures is a list, the signature checks that are immediately
+    # verified are deferred: they are appended to it as (msg, pubkey, sig) and
+    # must then be verified with find_invalid_signatures
+    def execute(self, memory, signatures=None):
+        return _execute_script(self, memory, signatures)
 
 
-def _pushdata(variable, data, memory):
-    memory[variable] = data
+OP_PUSHDATA = 0x00
+OP_EQUAL = 0x01
+OP_HASH256 = 0x02
+OP_SHNORR_CHECKSIG = 0x03
+OP_VERIFY = 0x04
 
+# number of operand bytes read by each opcode
+OPERANDS = {
+    OP_PUSHDATA: 0,
+    OP_EQUAL: 2,
+    OP_HASH256: 1,
+    OP_SHNORR_CHECKSIG: 2,
+    OP_VERIFY: 1,
+}
 
-def _equal(variable, data, memory):
-    if memory[data[0]] == memory[data[1]]:
-        memory[variable] = b"\x01"
-    else:
-        memory[variable] = b"\x00"
 
+# Cost of each opcode, pushing and hashing also cost one unit every
+# BYTES_PER_COST bytes. Scripts have no branches, so the cost of a script is
+# known before executing it
+OP_COSTS = {
+    OP_PUSHDATA: 1,
+    OP_EQUAL: 1,
+    OP_HASH256: 4,
+    OP_SHNORR_CHECKSIG: 50,
+    OP_VERIFY: 1,
+}
+BYTES_PER_COST = 64
+# budgets of a single script check and of all the checks of a block
+MAX_SCRIPT_COST = 10 ** 4
+MAX_BLOCK_COST = 10 ** 6
+MAX_BLOCK_SIGOPS = 2 * 10 ** 4
 
-def _hash256(variable, data, memory):
-    memory[variable] = hash256(memory[data[0]])
 
+class ScriptFailure(Exception):
+    pass
 
-def _schnorr_checksig(variable, data, memory):
-    is_valid = ssa._verify(memory[0x100], memory[data[0]], memory[data[1]])
-    if is_valid:
-        memory[variable] = b"\x01"
-    else:
-        memory[variable] = b"\x00"
 
+def _check_signature(signature):
+    if signature in signature_cache:
+        return True
+    if ssa._verify(*signature):
+        signature_cache.add(signature)
+        return True
+    return False
 
-def _verify(variable, data, memory):
-    if memory[data[0]] == b"\x00":
-        raise Exception
 
+# Each expression becomes a step(memory, signatures) closure with its operands
+# already decoded. If verified is True the result of the expression is only
+# checked by the OP_VERIFY that follows it, so a signature check can be deferred
+def _compile_expression(variable, function, data, verified=False):
+    if function == OP_PUSHDATA:
 
-OP_PUSHDATA = 0x00
-OP_EQUAL = 0x01
-OP_HASH256 = 0x02
-OP_SHNORR_CHECKSIG = 0x03
-OP_VERIFY = 0x04
+        def step(memory, signatures):
+            memory[variable] = data
 
-FUNCTIONS = {
-    OP_PUSHDATA: _pushdata,
-    OP_EQUAL: _equal,
-    OP_HASH256: _hash256,
-    OP_SHNORR_CHECKSIG: _schnorr_checksig,
-    OP_VERIFY: _verify,
-}
+    elif function == OP_EQUAL:
+        a, b = data[0], data[1]
 
+        def step(memory, signatures):
+            memory[variable] = b"\x01" if memory[a] == memory[b] else b"\x00"
 
-def _execute_script(script, memory={}):
-    memory = memory
-    for variable, function, data in script.expressions:
+    elif function == OP_HASH256:
+        a = data[0]
+
+        def step(memory, signatures):
+            memory[variable] = hash256(memory[a])
+
+    elif function == OP_SHNORR_CHECKSIG:
+        a, b = data[0], data[1]
+
+        def step(memory, signatures):
+            signature = (memory[0x100], memory[a], memory[b])
+            if verified and signatures is not None:
+                signatures.append(signature)
+                memory[variable] = b"\x01"  # if it is invalid the whole batch fails
+            elif _check_signature(signature):
+                memory[variable] = b"\x01"
+            else:
+                memory[variable] = b"\x00"
+
+    else:  # OP_VERIFY
+        a = data[0]
+
+        def step(memory, signatures):
+            if memory[a] == b"\x00":
+                raise ScriptFailure
+
+    return step
+
+
+# whether the result of the first expression is only checked by the second
+def _is_verified(expression, next_expression):
+    variable, function, data = expression
+    next_variable, next_function, next_data = next_expression
+    return (
+        function == OP_SHNORR_CHECKSIG
+        and next_function == OP_VERIFY
+        and next_data[:1] == bytes([variable])
+    )
+
+
+# A script whose operands have been checked and whose expressions have been
+# turned into closures. A script that cannot be compiled always fails
+class CompiledScript:
+    __slots__ = ("steps", "first", "last", "template")
+
+    def __init__(self, steps, first=None, last=None, template=None):
+        self.steps = steps
+        self.first = first  # first and last expressions, needed by __add__
+        self.last = last
+        self.template = template  # specialized verifier of standard spends
+
+    def __add__(self, other):
+        if self.steps is None or other.steps is None:
+            return INVALID_SCRIPT
+        if not self.steps:
+            return other
+        if not other.steps:
+            return self
+        steps = self.steps + other.steps
+        if _is_verified(self.last, other.first):
+            last_step = _compile_expression(*self.last, verified=True)
+            steps = self.steps[:-1] + (last_step,) + other.steps
+        return CompiledScript(steps, self.first, other.last)
+
+    def execute(self, memory, signatures=None):
+        if self.steps is None:
+            return False
         try:
-            FUNCTIONS[function](variable, data, memory)
-        except:
+            for step in self.steps:
+                step(memory, signatures)
+        except Exception:  # a failed OP_VERIFY or an unset variable
+            return False
+        return True
+
+
+INVALID_SCRIPT = CompiledScript(None)
+
+
+def compile_script(script):
+    expressions = script.expressions
+    for variable, function, data in expressions:
+        if function not in OPERANDS or len(data) < OPERANDS[function]:
+            return INVALID_SCRIPT
+    if not expressions:
+        return CompiledScript(())
+    steps = []
+    for i, expression in enumerate(expressions):
+        verified = i + 1 < len(expressions) and _is_verified(
+            expression, expressions[i + 1]
+        )
+        steps.append(_compile_expression(*expression, verified=verified))
+    first, last = expressions[0], expressions[-1]
+    return CompiledScript(tuple(steps), tuple(first), tuple(last))
+
+
+# The standard locking scripts built by sign_tx.lock_p2pk and lock_p2pkh: they
+# push a key or key hash to variable 2 and are followed by a fixed suffix
+P2PK_SUFFIX = Script(
+    [
+        [0xFF, OP_EQUAL, b"\x02\x00"],
+        [0xFF, OP_VERIFY, b"\xff"],
+        [0xFF, OP_SHNORR_CHECKSIG, b"\x00\x01"],
+        [0xFF, OP_VERIFY, b"\xff"],
+    ]
+).serialize()
+P2PKH_SUFFIX = Script(
+    [
+        [0x03, OP_HASH256, b"\x00"],
+        [0xFF, OP_EQUAL, b"\x03\x02"],
+        [0xFF, OP_VERIFY, b"\xff"],
+        [0xFF, OP_SHNORR_CHECKSIG, b"\x00\x01"],
+        [0xFF, OP_VERIFY, b"\xff"],
+    ]
+).serialize()
+
+
+# whether the unlocking script only pushes a pubkey to variable 0 and a
+# signature to variable 1, the only shape handled by the templates
+def _is_standard_unlocking(script):
+    expressions = script.expressions
+    return (
+        len(expressions) == 2
+        and expressions[0][0] == 0x00
+        and expressions[0][1] == OP_PUSHDATA
+        and expressions[1][0] == 0x01
+        and expressions[1][1] == OP_PUSHDATA
+    )
+
+
+# A template verifier does what the interpreter would do with a standard
+# unlocking script: one comparison and one signature check. It returns None if
+# the unlocking script is not standard
+def _template_verifier(expected, hashed):
+    def verify(sighash, unlocking_script, signatures=None):
+        if not _is_standard_unlocking(unlocking_script):
+            return None
+        pubkey = unlocking_script.expressions[0][2]
+        sig = unlocking_script.expressions[1][2]
+        if (hash256(pubkey) if hashed else pubkey) != expected:
+            return False
+        if signatures is not None:
+            signatures.append((sighash, pubkey, sig))
+            return True
+        return _check_signature((sighash, pubkey, sig))
+
+    return verify
+
+
+def _match_template(serialized):
+    if len(serialized) < 4 or serialized[2:4] != b"\x02\x00":
+        return None
+    end = int.from_bytes(serialized[:2], "big") + 2
+    if end < 4:
+        return None
+    suffix = serialized[end:]
+    if suffix == P2PK_SUFFIX:
+        return _template_verifier(serialized[4:end], hashed=False)
+    if suffix == P2PKH_SUFFIX:
+        return _template_verifier(serialized[4:end], hashed=True)
+    return None
+
+
+# LRU of the compiled locking scripts keyed by their serialization, outputs to
+# the same addresses share the same compiled script
+class CompiledScriptCache:
+    def __init__(self, max_size=2 ** 12):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.scripts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.scripts)
+
+    def get(self, script):
+        key = script.serialize()
+        with self.lock:
+            compiled = self.scripts.get(key)
+            if compiled is not None:
+                self.scripts.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = compile_script(script)
+        template = _match_template(key)
+        if template is not None:
+            compiled = CompiledScript(
+                compiled.steps, compiled.first, compiled.last, template
+            )
+        with self.lock:
+            if self.max_size:
+                self.scripts[key] = compiled
+                while len(self.scripts) > self.max_size:
+                    self.scripts.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self.lock:
+            self.scripts.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def _execute_script(script, memory={}, signatures=None):
+    return compile_script(script).execute(memory, signatures)
+
+
+# Bounded set of the valid (msg, pubkey, sig) signatures already verified, it is
+# shared by mempool and block validation. Keys are salted hashes and a random
+# entry is evicted when it is full, so an attacker can neither predict nor
+# flush its content
+class SignatureCache:
+    def __init__(self, max_size=2 ** 16):
+        self.max_size = max_size
+        self.salt = os.urandom(32)
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> position in keys
+        self.keys = []
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, signature):
+        key = sha256(self.salt)
+        for data in signature:
+            if isinstance(data, str):
+                data = data.encode()
+            key.update(len(data).to_bytes(4, "big") + data)
+        return key.digest()
+
+    def __contains__(self, signature):
+        key = self._key(signature)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, signature):
+        key = self._key(signature)
+        with self.lock:
+            if key in self.entries or not self.max_size:
+                return
+            if len(self.keys) >= self.max_size:
+                # the last key takes the place of the evicted one
+                i = random.randrange(len(self.keys))
+                del self.entries[self.keys[i]]
+                last = self.keys.pop()
+                if i < len(self.keys):
+                    self.keys[i] = last
+                    self.entries[last] = i
+            self.entries[key] = len(self.keys)
+            self.keys.append(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+signature_cache = SignatureCache()
+compiled_scripts = CompiledScriptCache()
+
+
+# checks many schnorr signatures with a single multi-scalar multiplication, the
+# signatures are verified one by one only if the batch fails. It returns the
+# invalid ones, the valid ones are added to the signature cache
+def find_invalid_signatures(signatures):
+    signatures = [s for s in signatures if s not in signature_cache]
+    if not signatures:
+        return []
+    try:
+        ms, pubkeys, sigs = zip(*signatures)
+        ssa._batch_verify(ms, pubkeys, sigs, secp256k1, sha256)
+        invalid = []
+    except Exception:
+        invalid = [s for s in signatures if not ssa._verify(*s)]
+    for signature in signatures:
+        if signature not in invalid:
+            signature_cache.add(signature)
+    return invalid
+
+
+# A script check is a (sighash, unlocking script, locking script) tuple, it is
+# independent from the others so checks can be verified in any order. Standard
+# spends of standard locking scripts skip the interpreter
+def verify_script(check, signatures=None):
+    sighash, unlocking_script, locking_script = check
+    compiled = compiled_scripts.get(locking_script)
+    if compiled.template is not None:
+        is_valid = compiled.template(sighash, unlocking_script, signatures)
+        if is_valid is not None:
+            return is_valid
+    script = compile_script(unlocking_script) + compiled
+    return script.execute(memory={0x100: sighash}, signatures=signatures)
+
+
+# returns the (cost, sigops) of executing the script, the size of every
+# variable is tracked to price the hashes
+def script_cost(script):
+    sizes = {0x100: 32}
+    cost = 0
+    sigops = 0
+    for variable, function, data in script.expressions:
+        cost += OP_COSTS.get(function, 0)
+        if function == OP_PUSHDATA:
+            cost += len(data) // BYTES_PER_COST
+            sizes[variable] = len(data)
+        elif function == OP_HASH256 and data:
+            cost += sizes.get(data[0], 0) // BYTES_PER_COST
+            sizes[variable] = 32
+        elif function == OP_EQUAL:
+            sizes[variable] = 1
+        elif function == OP_SHNORR_CHECKSIG:
+            sizes[variable] = 1
+            sigops += 1
+    return cost, sigops
+
+
+def check_cost(check):
+    sighash, unlocking_script, locking_script = check
+    return script_cost(unlocking_script + locking_script)
+
+
+# returns the signatures verified by the checks, None if one of them fails
+def _verify_script_batch(checks, batch_signatures=False):
+    signatures = []
+    for check in checks:
+        if not verify_script(check, signatures):
+            return None
+    if batch_signatures:
+        if find_invalid_signatures(signatures):
+            return None
+    else:
+        for signature in signatures:
+            if signature not in signature_cache:
+                if not ssa._verify(*signature):
+                    return None
+                signature_cache.add(signature)
+    return signatures
+
+
+# verifies every check, stopping at the first failure. With an executor the
+# checks are split in batches verified in parallel, the pending ones are
+# cancelled as soon as one fails. With batch_signatures the signatures of each
+# batch are verified together
+def verify_scripts(checks, executor=None, batch_size=16, batch_signatures=False):
+    if executor is None or len(checks) <= batch_size:
+        return _verify_script_batch(checks, batch_signatures) is not None
+    # the workers only have the signature cache they were started with, the
+    # checks whose signatures are all cached here are not sent to them
+    pending = []
+    for check in checks:
+        signatures = []
+        if not verify_script(check, signatures):
             return False
-    return True
+        if any(signature not in signature_cache for signature in signatures):
+            pending.append(check)
+    checks = pending
+    futures = [
+        executor.submit(
+            _verify_script_batch, checks[i : i + batch_size], batch_signatures
+        )
+        for i in range(0, len(checks), batch_size)
+    ]
+    try:
+        for future in as_completed(futures):
+            signatures = future.result()
+            if signatures is None:
+                return False
+            for signature in signatures:
+                signature_cache.add(signature)
+        return True
+    finally:
+        for future in futures:
+            future.cancel()
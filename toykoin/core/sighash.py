@@ -1,7 +1,26 @@
-from toykoin.core.script import Script
+from toykoin.core.utils import hash256
 
 
-def sighash_all(tx):
+# the serialization of tx with every unlocking script empty, written directly
+# from the inputs and outputs without copying the transaction
+def _stripped_serialization(tx):
+    out = [len(tx.inputs).to_bytes(2, "big")]
     for tx_in in tx.inputs:
-        tx_in.unlocking_script = Script()
-    return tx.txid
+        prevout = tx_in.prevout.serialize()
+        out.append((len(prevout) + 2).to_bytes(2, "big") + prevout + b"\x00\x00")
+    out.append(len(tx.outputs).to_bytes(2, "big"))
+    for tx_out in tx.outputs:
+        tx_out_bytes = tx_out.serialize()
+        out.append(len(tx_out_bytes).to_bytes(2, "big") + tx_out_bytes)
+    return b"".join(out)
+
+
+def _sighash_all(tx):
+    return hash256(_stripped_serialization(tx))
+
+
+# the digest commits to the transaction with every unlocking script cleared, so
+# it is the same for all the inputs: it is memoized while tx is sealed and the
+# caller's transaction is never modified
+def sighash_all(tx):
+    return tx.cached("sighash_all", _sighash_all)
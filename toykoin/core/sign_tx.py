@@ -7,6 +7,7 @@ from toykoin.core.script import (
     OP_VERIFY,
 )
 from toykoin.core.utils import hash256
+from toykoin.core.sighash import sighash_all
 
 from btclib import ssa
 from btclib.curve import mult
@@ -63,3 +64,12 @@ def unlock_p2pkh(sighash, prvkey):
     return Script(
         [[0x00, OP_PUSHDATA, pubkey], [0x01, OP_PUSHDATA, sig]]
     )  # push signature
+
+
+# signs every input of tx, the i-th one is unlocked by prvkeys[i] with unlock.
+# The digest is computed once for all the inputs
+def sign_tx(tx, prvkeys, unlock=unlock_p2pkh):
+    sighash = sighash_all(tx)
+    for tx_in, prvkey in zip(tx.inputs, prvkeys):
+        tx_in.unlocking_script = unlock(sighash, prvkey)
+    return tx.unseal()  # the unlocking scripts changed the txid
@@ -0,0 +1,102 @@
+import mmap
+import os
+
+# size over which a new segment file is started
+SEGMENT_SIZE = 128 * 2 ** 20
+
+
+# Append-only store of records split in numbered segment files, e.g.
+# blocks/blk00000.dat. A record is located by its (file, offset, length)
+# position and is read through a memory map of its segment
+class SegmentStore:
+    def __init__(self, directory, prefix, max_file_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        os.makedirs(directory, exist_ok=True)
+        self.file = 0  # the last segment, the older ones may have been pruned
+        for filename in os.listdir(directory):
+            number = filename[len(prefix) : -len(".dat")]
+            if filename.startswith(prefix) and filename.endswith(".dat"):
+                if number.isdigit():
+                    self.file = max(self.file, int(number))
+        self.writer = None
+        self.maps = {}  # file -> mmap
+
+    def _path(self, file):
+        return os.path.join(self.directory, f"{self.prefix}{file:05d}.dat")
+
+    def _open_writer(self):
+        if self.writer is None:
+            self.writer = open(self._path(self.file), "ab")
+        return self.writer
+
+    def append(self, data):
+        writer = self._open_writer()
+        offset = writer.tell()
+        if offset and offset + len(data) > self.max_file_size:
+            writer.close()
+            self.file += 1
+            self.writer = None
+            writer = self._open_writer()
+            offset = 0
+        writer.write(data)
+        return self.file, offset, len(data)
+
+    # the next records are appended to a new segment file
+    def start_file(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.file += 1
+
+    # makes the appended records readable, and durable if sync
+    def flush(self, sync=True):
+        if self.writer is not None:
+            self.writer.flush()
+            if sync:
+                os.fsync(self.writer.fileno())
+
+    # numbers of the existing segment files
+    def files(self):
+        return [
+            file for file in range(self.file + 1) if os.path.exists(self._path(file))
+        ]
+
+    def file_size(self, file):
+        if file == self.file and self.writer is not None:
+            return self.writer.tell()
+        return os.path.getsize(self._path(file))
+
+    def size(self):
+        return sum(self.file_size(file) for file in self.files())
+
+    # deletes a segment file, it cannot be the one being appended to
+    def remove(self, file):
+        if file == self.file:
+            raise Exception
+        view = self.maps.pop(file, None)
+        if view is not None:
+            view.close()
+        os.remove(self._path(file))
+
+    def read(self, position):
+        file, offset, length = position
+        if file == self.file and self.writer is not None:
+            self.writer.flush()
+        view = self.maps.get(file)
+        if view is None or len(view) < offset + length:
+            if view is not None:
+                view.close()
+            with open(self._path(file), "rb") as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[file] = view
+        return view[offset : offset + length]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for view in self.maps.values():
+            view.close()
+        self.maps = {}
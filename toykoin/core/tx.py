@@ -1,30 +1,51 @@
 from toykoin.core.utils import hash256
 from toykoin.core.script import Script
 
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+# OutPoint, TxIn and TxOut are slotted, the mempool and the UTXO cache keep a
+# lot of them alive. Hashes are stored as raw bytes, hex is only for display
 
 
-@dataclass
 class OutPoint:
-    hash: str
-    index: int
+    __slots__ = ("hash", "index")
+
+    def __init__(self, hash, index):
+        if isinstance(hash, str):
+            hash = bytes.fromhex(hash)
+        self.hash = hash
+        self.index = index
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.hash == other.hash and self.index == other.index
+
+    def __hash__(self):
+        return hash((self.hash, self.index))
+
+    def __repr__(self):
+        return f"OutPoint(hash={self.hash.hex()!r}, index={self.index!r})"
 
     @property
     def hex(self):
-        return self.hash + self.index.to_bytes(2, "big").hex()
+        return self.serialize().hex()
 
+    # the 34 bytes serialization is also the key of the outpoint in the UTXO set
     def serialize(self):
-        return bytes.fromhex(self.hex)
+        return self.hash + self.index.to_bytes(2, "big")
 
     @classmethod
     def deserialize(cls, data):
-        hash = data[:32].hex()
+        data = memoryview(data)
+        hash = bytes(data[:32])
         index = int.from_bytes(data[32:34], "big")
         return OutPoint(hash, index)
 
     def is_coinbase(self):
-        return self.hash == "00" * 32 and self.index == 0
+        return self.hash == b"\x00" * 32 and self.index == 0
 
     def is_valid(self):
         if not 0 <= self.index < 256 ** 2:
@@ -32,10 +53,28 @@ class OutPoint:
         return True
 
 
-@dataclass
 class TxIn:
-    prevout: OutPoint
-    unlocking_script: Script = Script()
+    __slots__ = ("prevout", "unlocking_script")
+
+    def __init__(self, prevout, unlocking_script=None):
+        self.prevout = prevout
+        if unlocking_script is None:
+            unlocking_script = Script()
+        self.unlocking_script = unlocking_script
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (
+            self.prevout == other.prevout
+            and self.unlocking_script == other.unlocking_script
+        )
+
+    def __repr__(self):
+        return (
+            f"TxIn(prevout={self.prevout!r}, "
+            f"unlocking_script={self.unlocking_script!r})"
+        )
 
     def serialize(self):
         out = self.prevout.serialize()
@@ -45,6 +84,7 @@ class TxIn:
 
     @classmethod
     def deserialize(cls, data):
+        data = memoryview(data)
         prevout = OutPoint.deserialize(data)
         script_len = int.from_bytes(data[34:36], "big")
         unlocking_script = Script.deserialize(data[36 : 36 + script_len])
@@ -61,10 +101,22 @@ class TxIn:
         return True
 
 
-@dataclass
 class TxOut:
-    value: int = 0
-    locking_script: Script = Script()
+    __slots__ = ("value", "locking_script")
+
+    def __init__(self, value=0, locking_script=None):
+        self.value = value
+        if locking_script is None:
+            locking_script = Script()
+        self.locking_script = locking_script
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.value == other.value and self.locking_script == other.locking_script
+
+    def __repr__(self):
+        return f"TxOut(value={self.value!r}, locking_script={self.locking_script!r})"
 
     def serialize(self):
         out = self.value.to_bytes(8, "big")
@@ -74,6 +126,7 @@ class TxOut:
 
     @classmethod
     def deserialize(cls, data):
+        data = memoryview(data)
         out = int.from_bytes(data[:8], "big")
         script_len = int.from_bytes(data[8:10], "big")
         locking_script = Script.deserialize(data[10 : 10 + script_len])
@@ -91,8 +144,42 @@ class TxOut:
 class Tx:
     inputs: List[TxIn]
     outputs: List[TxOut]
+    _cache: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        # assigning a field drops the memoized serialization and hash
+        super().__setattr__(name, value)
+        if name != "_cache":
+            super().__setattr__("_cache", None)
+
+    # a sealed transaction memoizes its serialization and hash. Assigning inputs
+    # or outputs unseals it, but in-place changes (e.g. replacing an unlocking
+    # script) are not detected: call unseal() before them and seal() again after
+    def seal(self):
+        if self._cache is None:
+            serialized = self.serialize()
+            self._cache = {"serialized": serialized, "hash": hash256(serialized)}
+        return self
+
+    def unseal(self):
+        self._cache = None
+        return self
+
+    @property
+    def sealed(self):
+        return self._cache is not None
+
+    # memoizes compute(self) under key while the transaction is sealed
+    def cached(self, key, compute):
+        if self._cache is None:
+            return compute(self)
+        if key not in self._cache:
+            self._cache[key] = compute(self)
+        return self._cache[key]
 
     def serialize(self):
+        if self._cache is not None:
+            return self._cache["serialized"]
         out = len(self.inputs).to_bytes(2, "big")
         for tx_in in self.inputs:
             tx_in_bytes = tx_in.serialize()
@@ -105,22 +192,22 @@ class Tx:
 
     @classmethod
     def deserialize(cls, data):
+        # offset based: slicing a memoryview does not copy the underlying buffer
+        data = memoryview(data)
         inputs = []
         inputs_len = int.from_bytes(data[:2], "big")
-        data = data[2:]
-        for i in range(inputs_len):
-            input_len = int.from_bytes(data[:2], "big")
-            data = data[2:]
-            inputs.append(TxIn.deserialize(data[:input_len]))
-            data = data[input_len:]
+        i = 2
+        for _ in range(inputs_len):
+            input_len = int.from_bytes(data[i : i + 2], "big")
+            inputs.append(TxIn.deserialize(data[i + 2 : i + 2 + input_len]))
+            i += 2 + input_len
         outputs = []
-        outputs_len = int.from_bytes(data[:2], "big")
-        data = data[2:]
-        for i in range(outputs_len):
-            output_len = int.from_bytes(data[:2], "big")
-            data = data[2:]
-            outputs.append(TxOut.deserialize(data[:output_len]))
-            data = data[output_len:]
+        outputs_len = int.from_bytes(data[i : i + 2], "big")
+        i += 2
+        for _ in range(outputs_len):
+            output_len = int.from_bytes(data[i : i + 2], "big")
+            outputs.append(TxOut.deserialize(data[i + 2 : i + 2 + output_len]))
+            i += 2 + output_len
         return Tx(inputs, outputs)
 
     def is_coinbase(self):
@@ -128,7 +215,7 @@ class Tx:
 
     # confirm that is a valid transaction only by looking at its data, without looking at the blockchain
     def is_valid(self):
-        outpoints = []
+        outpoints = set()
         coinbase = self.is_coinbase()
         for tx_in in self.inputs:
             # the transaction is not coinbase but has a coinbase input
@@ -136,7 +223,7 @@ class Tx:
                 return False
             if tx_in.prevout in outpoints:  # duplicate reference
                 return False
-            outpoints.append(tx_in.prevout)
+            outpoints.add(tx_in.prevout)
             if not tx_in.is_valid():
                 return False
         for tx_out in self.outputs:
@@ -144,6 +231,12 @@ class Tx:
                 return False
         return True
 
+    @property
+    def hash(self):
+        if self._cache is not None:
+            return self._cache["hash"]
+        return hash256(self.serialize())
+
     @property
     def txid(self):
-        return hash256(self.serialize()).hex()
+        return self.hash.hex()
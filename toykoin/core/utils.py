@@ -1,23 +1,154 @@
 from btclib.utils import hash256
+from dataclasses import dataclass
 import shutil
+import gc
 import os
 
 
+# Merkle tree whose levels are kept between updates, levels[0] are the leaves
+# and the last level is the root. A level with an odd number of nodes pairs the
+# last one with itself. Appending or replacing leaves only marks them dirty, the
+# nodes above them are recomputed when the root or a proof is requested
+class MerkleTree:
+    def __init__(self, leaves=()):
+        self.levels = [list(leaves)]
+        self.dirty = set(range(len(self.levels[0])))
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self, leaf):
+        self.dirty.add(len(self.levels[0]))
+        self.levels[0].append(leaf)
+
+    def __setitem__(self, index, leaf):
+        self.levels[0][index] = leaf
+        self.dirty.add(index)
+
+    def _update(self):
+        if not self.dirty:
+            return
+        dirty = self.dirty
+        level = 0
+        while len(self.levels[level]) > 1:
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            nodes = self.levels[level]
+            parents = self.levels[level + 1]
+            dirty = sorted({i // 2 for i in dirty})
+            for i in dirty:
+                left = nodes[2 * i]
+                right = nodes[2 * i + 1] if 2 * i + 1 < len(nodes) else left
+                if i < len(parents):
+                    parents[i] = hash256(left + right)
+                else:
+                    parents.append(hash256(left + right))
+            level += 1
+        self.dirty = set()
+
+    @property
+    def root(self):
+        if not self.levels[0]:
+            return hash256(b"")
+        self._update()
+        return self.levels[-1][0]
+
+    # the siblings of the nodes on the path from the index-th leaf to the root
+    def proof(self, index):
+        self._update()
+        proof = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            proof.append(nodes[sibling] if sibling < len(nodes) else nodes[index])
+            index //= 2
+        return proof
+
+
+def verify_merkle_proof(leaf, index, proof, root):
+    for sibling in proof:
+        if index % 2:
+            leaf = hash256(sibling + leaf)
+        else:
+            leaf = hash256(leaf + sibling)
+        index //= 2
+    return leaf == root
+
+
 def generate_merkle_root(transactions):
-    if len(transactions) == 0:
-        return hash256(b"")
-    hashes = [bytes.fromhex(transaction.txid) for transaction in transactions]
-    hashes_buffer = []
-    while len(hashes) != 1:
-        if len(hashes) % 2 != 0:
-            hashes.append(hashes[-1])
-        for x in range(len(hashes) // 2):
-            hashes_buffer.append(hash256(hashes[2 * x] + hashes[2 * x + 1]))
-        hashes = hashes_buffer[:]
-        hashes_buffer = []
-    return hashes[0].hex()
+    return MerkleTree([transaction.hash for transaction in transactions]).root
 
 
 def reset_blockchain(name="regtest"):
+    gc.collect()
     base_dir = os.path.join(os.path.expanduser("~"), ".toykoin", name)
     shutil.rmtree(base_dir)
+
+
+# every sqlite store records the version of its tables in schema_version, a
+# missing entry means either a new database or one created before versioning
+def get_schema_version(cursor, name):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS schema_version "
+        "(name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID"
+    )
+    cursor.execute("SELECT version FROM schema_version WHERE name = ?", (name,))
+    version = cursor.fetchone()
+    return version[0] if version else 0
+
+
+def set_schema_version(cursor, name, version):
+    cursor.execute(
+        "INSERT OR REPLACE INTO schema_version VALUES (?, ?)", (name, version)
+    )
+
+
+def table_exists(cursor, name):
+    cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    )
+    return cursor.fetchone() is not None
+
+
+# ids written before the tables were typed were hex strings
+def legacy_id(id):
+    return bytes.fromhex(id) if isinstance(id, str) else id
+
+
+# How a store trades durability for speed. Blocks are committed in groups of
+# commit_blocks, or after commit_seconds since the last commit, and the
+# segment files are fsynced at commit only if sync_files
+@dataclass(frozen=True)
+class DurabilityProfile:
+    name: str
+    journal_mode: str = "WAL"
+    synchronous: str = "FULL"
+    cache_size: int = 32 * 2 ** 20  # bytes of sqlite page cache
+    mmap_size: int = 256 * 2 ** 20
+    commit_blocks: int = 1
+    commit_seconds: float = 0
+    sync_files: bool = True
+
+
+PROFILES = {
+    # initial block download, a crash can lose the last uncommitted blocks but
+    # never leaves an inconsistent chainstate
+    "ibd": DurabilityProfile(
+        "ibd",
+        synchronous="OFF",
+        cache_size=256 * 2 ** 20,
+        mmap_size=2 ** 30,
+        commit_blocks=1000,
+        commit_seconds=30,
+        sync_files=False,
+    ),
+    "safe": DurabilityProfile("safe"),
+}
+
+
+def apply_durability_profile(cursor, profile):
+    cursor.execute(f"PRAGMA journal_mode = {profile.journal_mode}")
+    cursor.fetchall()
+    cursor.execute(f"PRAGMA synchronous = {profile.synchronous}")
+    cursor.execute(f"PRAGMA cache_size = {-(profile.cache_size // 1024)}")
+    cursor.execute(f"PRAGMA mmap_size = {profile.mmap_size}")
+    cursor.fetchall()
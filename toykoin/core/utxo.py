@@ -1,54 +1,305 @@
 from toykoin.core.block import Block, BlockHeader, RevBlock
 from toykoin.core.tx import OutPoint, TxOut
-from toykoin.core.script import Script
+from toykoin.core.script import (
+    Script,
+    verify_scripts,
+    check_cost,
+    MAX_SCRIPT_COST,
+    MAX_BLOCK_COST,
+    MAX_BLOCK_SIGOPS,
+)
 from toykoin.core.sighash import sighash_all
+from toykoin.core.utils import (
+    get_schema_version,
+    set_schema_version,
+    table_exists,
+    legacy_id,
+    apply_durability_profile,
+    PROFILES,
+)
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import os
 import sqlite3
 
+# rough memory footprint of a cached coin, its script excluded
+UTXO_ENTRY_SIZE = 200
+# default memory budget of the coin cache, in bytes
+UTXO_CACHE_SIZE = 32 * 2 ** 20
+# ids bound to a single query, well below the sqlite variable limit
+QUERY_BATCH_SIZE = 500
 
+
+# Write-back cache of the utxo table. Clean coins mirror the database and are
+# evicted in LRU order when the cache grows over max_size bytes. Changes are
+# kept as dirty entries (a None coin marks a spent one) until flush() writes
+# them in one batch, or rollback() discards them. A fresh coin was never
+# written to the database, spending it before a flush drops it from the cache
+class UTXOCache:
+    def __init__(self, cursor, max_size=UTXO_CACHE_SIZE):
+        self.cursor = cursor
+        self.max_size = max_size
+        self.size = 0
+        self.clean = OrderedDict()  # id -> (utxo, size)
+        self.dirty = {}  # id -> (utxo or None, script bytes, fresh)
+
+    def get(self, id):
+        if id in self.dirty:
+            return self.dirty[id][0]
+        entry = self.clean.get(id)
+        if entry is not None:
+            self.clean.move_to_end(id)
+            return entry[0]
+        self.cursor.execute("SELECT value, script FROM utxo WHERE id = ?", (id,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        utxo = TxOut(row[0], Script.deserialize(row[1]))
+        self._add_clean(id, utxo, UTXO_ENTRY_SIZE + len(row[1]))
+        return utxo
+
+    # looks up many coins, the ones not cached are loaded with batched queries
+    def get_many(self, ids):
+        utxos = {}
+        missing = []
+        for id in ids:
+            if id in self.dirty or id in self.clean:
+                utxo = self.get(id)
+                if utxo:
+                    utxos[id] = utxo
+            else:
+                missing.append(id)
+        for i in range(0, len(missing), QUERY_BATCH_SIZE):
+            batch = missing[i : i + QUERY_BATCH_SIZE]
+            self.cursor.execute(
+                "SELECT id, value, script FROM utxo WHERE id IN (%s)"
+                % ", ".join("?" * len(batch)),
+                batch,
+            )
+            for id, value, script in self.cursor.fetchall():
+                utxo = TxOut(value, Script.deserialize(script))
+                self._add_clean(id, utxo, UTXO_ENTRY_SIZE + len(script))
+                utxos[id] = utxo
+        return utxos
+
+    def add(self, id, utxo):
+        fresh = self._pop(id) is not False  # validation forbids overwrites
+        script = utxo.locking_script.serialize()
+        self.dirty[id] = (utxo, script, fresh)
+        self.size += UTXO_ENTRY_SIZE + len(script)
+
+    def remove(self, id):
+        if not self._pop(id):
+            self.dirty[id] = (None, b"", False)
+            self.size += UTXO_ENTRY_SIZE
+
+    # removes the cached entry of id, returns whether the coin is missing from
+    # the database, or None if it is unknown
+    def _pop(self, id):
+        if id in self.dirty:
+            utxo, script, fresh = self.dirty.pop(id)
+            self.size -= UTXO_ENTRY_SIZE + len(script)
+            return fresh
+        if id in self.clean:
+            self.size -= self.clean.pop(id)[1]
+            return False
+        return None
+
+    def _add_clean(self, id, utxo, size):
+        self.clean[id] = (utxo, size)
+        self.size += size
+        while self.size > self.max_size and self.clean:
+            self.size -= self.clean.popitem(last=False)[1][1]
+
+    # ids of the spent and of the created coins that are not in the database
+    def changes(self):
+        spent = {id for id, entry in self.dirty.items() if entry[0] is None}
+        return spent, set(self.dirty) - spent
+
+    # writes every change in one batch, it does not commit
+    def flush(self):
+        spent = [(id,) for id, entry in self.dirty.items() if entry[0] is None]
+        created = [
+            (id, utxo.value, script)
+            for id, (utxo, script, fresh) in self.dirty.items()
+            if utxo is not None
+        ]
+        self.cursor.executemany("DELETE FROM utxo WHERE id = ?", spent)
+        self.cursor.executemany("INSERT OR REPLACE INTO utxo VALUES (?, ?, ?)", created)
+        dirty, self.dirty = self.dirty, {}
+        self.size = sum(entry[1] for entry in self.clean.values())
+        for id, (utxo, script, fresh) in dirty.items():
+            if utxo is not None:
+                self._add_clean(id, utxo, UTXO_ENTRY_SIZE + len(script))
+
+    def rollback(self):
+        for id in list(self.dirty):
+            self._pop(id)
+
+    def clear(self):
+        self.clean.clear()
+        self.dirty.clear()
+        self.size = 0
+
+
+# The coins a block can spend: every coin its transactions reference, loaded
+# at once before validation, plus the outputs created by the block itself
+class BlockView:
+    def __init__(self, utxo_set, block):
+        ids = []
+        if block.transactions:
+            coinbase = block.transactions[0]
+            txid = coinbase.hash
+            ids += [OutPoint(txid, i).serialize() for i in range(len(coinbase.outputs))]
+        for tx in block.transactions[1:]:
+            ids += [tx_in.prevout.serialize() for tx_in in tx.inputs]
+        self.coins = utxo_set.get_utxos(ids)
+        self.created = set()
+
+    def get(self, id):
+        return self.coins.get(id)
+
+    def add_outputs(self, tx):
+        txid = tx.hash
+        for i, tx_out in enumerate(tx.outputs):
+            id = OutPoint(txid, i).serialize()
+            self.coins[id] = tx_out
+            self.created.add(id)
+
+
+# with script_workers > 0 the scripts of a block are verified on a pool of
+# that many processes, otherwise they are verified serially. With
+# batch_signatures the signatures of a block are verified in batches. If db is
+# given the utxo table is kept in that connection, shared with its owner that
+# also sets its durability, otherwise profile names one of PROFILES
 class UTXOSet:
-    def __init__(self, location="", name="utxo_set"):
-        self.db = sqlite3.connect(os.path.join(location, name + ".sqlite"))
+    def __init__(
+        self,
+        location="",
+        name="utxo_set",
+        cache_size=UTXO_CACHE_SIZE,
+        script_workers=0,
+        batch_signatures=False,
+        db=None,
+        profile="safe",
+    ):
+        self.owns_db = db is None
+        if db is None:
+            db = sqlite3.connect(os.path.join(location, name + ".sqlite"))
+        self.db = db
         self.cursor = self.db.cursor()
-        try:  # initializing db
-            self.cursor.execute("CREATE TABLE utxo (id, value, script)")
+        if self.owns_db:
+            apply_durability_profile(self.cursor, PROFILES[profile])
+        self.flushed = False  # changes written but not committed
+        self._upgrade_db()
+        self.cache = UTXOCache(self.cursor, cache_size)
+        self.script_workers = script_workers
+        self.script_executor = None
+        self.batch_signatures = batch_signatures
+
+    def get_script_executor(self):
+        if self.script_workers and not self.script_executor:
+            self.script_executor = ProcessPoolExecutor(self.script_workers)
+        return self.script_executor
+
+    def close(self):
+        if self.script_executor:
+            self.script_executor.shutdown()
+            self.script_executor = None
+        if self.owns_db:
+            self.db.close()
+
+    # creates the tables, or migrates them from an older schema, in a single
+    # transaction
+    def _upgrade_db(self):
+        self.cursor.execute("BEGIN")
+        version = get_schema_version(self.cursor, "utxo")
+        if version < 1:
+            legacy = table_exists(self.cursor, "utxo")
+            if legacy:  # untyped table without any key
+                self.cursor.execute("ALTER TABLE utxo RENAME TO utxo_v0")
+            self.cursor.execute(
+                "CREATE TABLE utxo (id BLOB PRIMARY KEY, value INTEGER NOT NULL, "
+                "script BLOB NOT NULL) WITHOUT ROWID"
+            )
+            if legacy:
+                self.cursor.execute("SELECT id, value, script FROM utxo_v0")
+                utxos = [(legacy_id(id), v, s) for id, v, s in self.cursor.fetchall()]
+                self.cursor.executemany("INSERT INTO utxo VALUES (?, ?, ?)", utxos)
+                self.cursor.execute("DROP TABLE utxo_v0")
+            set_schema_version(self.cursor, "utxo", 1)
+        self.db.commit()
+
+    # writes the cached changes to the database, it does not commit
+    def flush(self):
+        self.flushed = True
+        try:
+            self.cache.flush()
         except:
-            pass
+            self.cache.clear()
+            raise
+
+    # writes the cached changes and commits them to the database
+    def commit(self):
+        self.flush()
+        self.db.commit()
+        self.flushed = False
+
+    # discards the cached changes that were not flushed
+    def discard(self):
+        self.cache.rollback()
+
+    # discards every change since the last commit
+    def rollback(self):
+        if self.flushed:  # the cache holds coins whose writes are rolled back
+            self.cache.clear()
+        else:
+            self.cache.rollback()
+        self.db.rollback()
+        self.flushed = False
 
     def get_utxo_list(self):
         self.cursor.execute("SELECT id FROM utxo")
-        id_list = self.cursor.fetchall()
-        return id_list
+        spent, created = self.cache.changes()
+        id_list = {id for id, in self.cursor.fetchall()} - spent | created
+        return [(id,) for id in sorted(id_list)]
 
     def get_utxo(self, id):
-        self.cursor.execute("SELECT * FROM utxo WHERE id = ?", (id,))
-        utxo = self.cursor.fetchall()
-        return TxOut(utxo[0][1], Script.deserialize(utxo[0][2])) if utxo else None
+        return self.cache.get(id)
+
+    # dict of the existing coins among ids
+    def get_utxos(self, ids):
+        return self.cache.get_many(ids)
 
     # does not commit to database
     def add_utxo(self, id, utxo):
-        self.cursor.execute(
-            "INSERT INTO utxo VALUES (?, ?, ?)",
-            (id, utxo.value, utxo.locking_script.serialize()),
-        )
+        self.cache.add(id, utxo)
 
     # does not commit to database
     def remove_utxo(self, id):
-        self.cursor.execute("DELETE FROM utxo WHERE id = ?", (id,))
+        self.cache.remove(id)
 
     # confirm is a valid transaction by
-    def validate_transaction(self, tx):
+    # the spent coins are looked up in view if it is given, if script_checks is
+    # given the script checks are appended to it instead of being verified
+    # if costs is a dict the (cost, sigops) of the scripts of tx is stored in
+    # it with the txid as key. A script check over MAX_SCRIPT_COST is invalid.
+    # If checked is True tx already passed its contextless checks
+    def validate_transaction(
+        self, tx, view=None, script_checks=None, costs=None, checked=False
+    ):
 
-        if not tx.is_valid():
+        if not checked and not tx.is_valid():
             return False
 
+        get_utxo = view.get if view else self.get_utxo
         available_value = 0
         spending_value = 0
         previous_outputs = []
         for tx_in in tx.inputs:
-            id = tx_in.prevout.hex
-            tx_out = self.get_utxo(id)
+            id = tx_in.prevout.serialize()
+            tx_out = get_utxo(id)
             if not tx_out:
                 return False
             previous_outputs.append(tx_out)
@@ -60,61 +311,120 @@ class UTXOSet:
         if spending_value > available_value:
             return False
 
-        for tx_in, tx_out in zip(tx.inputs, previous_outputs):
-            script = tx_in.unlocking_script + tx_out.locking_script
-            # script.sighashes = [sighash_all(tx)]  # insert tx_out hashes
-            result = script.execute(memory={0x100: sighash_all(tx)})
-            if not result:
+        sighash = sighash_all(tx)
+        checks = [
+            (sighash, tx_in.unlocking_script, tx_out.locking_script)
+            for tx_in, tx_out in zip(tx.inputs, previous_outputs)
+        ]
+        tx_cost = 0
+        tx_sigops = 0
+        for check in checks:
+            cost, sigops = check_cost(check)
+            if cost > MAX_SCRIPT_COST:
                 return False
-        return True
+            tx_cost += cost
+            tx_sigops += sigops
+        if costs is not None:
+            costs[tx.hash] = (tx_cost, tx_sigops)
+        if script_checks is not None:
+            script_checks += checks
+            return True
+        return verify_scripts(checks)
 
     # check if the coinbase is trying to overwrite previous coinbase outputs
-    def validate_coinbase(self, coinbase):
+    def validate_coinbase(self, coinbase, view=None):
+        get_utxo = view.get if view else self.get_utxo
+        txid = coinbase.hash
         for i, tx_out in enumerate(coinbase.outputs):
-            id = OutPoint(coinbase.txid, i).hex
-            if self.get_utxo(id):
+            id = OutPoint(txid, i).serialize()
+            if get_utxo(id):
                 return False
         return True
 
-    def validate_block(self, block):
-        if not block.is_valid():
+    # a transaction can spend the outputs of the ones before it in the block.
+    # The scripts of a block must fit in MAX_BLOCK_COST and MAX_BLOCK_SIGOPS,
+    # the cost of each transaction is stored in costs as in validate_transaction.
+    # If check_scripts is False every check but the scripts execution is done,
+    # if checked is True block already passed the checks of Block.is_valid
+    def validate_block(
+        self, block, view=None, costs=None, check_scripts=True, checked=False
+    ):
+        if not checked and not block.is_valid():
             return False
-        if not self.validate_coinbase(block.transactions[0]):
+        if view is None:
+            view = BlockView(self, block)
+        if not self.validate_coinbase(block.transactions[0], view):
             return False
+        view.add_outputs(block.transactions[0])
+        script_checks = []
+        if costs is None:
+            costs = {}
+        block_cost = 0
+        block_sigops = 0
         for tx in block.transactions[1:]:  # do not check the coinbases
-            if not self.validate_transaction(tx):
+            if not self.validate_transaction(tx, view, script_checks, costs, checked):
                 return False
+            cost, sigops = costs[tx.hash]
+            block_cost += cost
+            block_sigops += sigops
+            if block_cost > MAX_BLOCK_COST or block_sigops > MAX_BLOCK_SIGOPS:
+                return False
+            view.add_outputs(tx)
         # check if miner is collecting fees in the right way
         total_value = 0
         for tx in block.transactions[1:]:
             for tx_in in tx.inputs:
-                id = tx_in.prevout.hex
-                total_value += self.get_utxo(id).value
+                id = tx_in.prevout.serialize()
+                total_value += view.get(id).value
             for tx_out in tx.outputs:
                 total_value -= tx_out.value
         for tx_out in block.transactions[0].outputs:
             total_value -= tx_out.value
         if 10 ** 10 + total_value < 0:
             return False
-        return True
+        if not check_scripts:
+            return True
+        # the scripts are the most expensive check, they are verified last
+        executor = self.get_script_executor()
+        if executor and self.batch_signatures:  # one batch for each worker
+            batch_size = -(-len(script_checks) // self.script_workers)
+        else:
+            batch_size = 16
+        return verify_scripts(
+            script_checks, executor, max(batch_size, 16), self.batch_signatures
+        )
 
-    def add_block(self, block):
-        rev_block = RevBlock(block.header.pow, [], [])
-        if not self.validate_block(block):
+    def add_block(self, block, check_scripts=True, checked=False):
+        block.seal()  # every txid is hashed once for the whole connection
+        rev_block = RevBlock(block.header.hash, [], [])
+        view = BlockView(self, block)
+        if not self.validate_block(
+            block, view, check_scripts=check_scripts, checked=checked
+        ):
             raise Exception
+        spent_created = set()
+        coinbase_txid = block.transactions[0].hash
         for i, tx_out in enumerate(block.transactions[0].outputs):
-            complete_id = OutPoint(block.transactions[0].txid, i).hex
+            complete_id = OutPoint(coinbase_txid, i).serialize()
             self.add_utxo(complete_id, tx_out)
             rev_block.removable.append(complete_id)
         for tx in block.transactions[1:]:
+            txid = tx.hash
             for i, tx_out in enumerate(tx.outputs):
-                complete_id = OutPoint(tx.txid, i).hex
+                complete_id = OutPoint(txid, i).serialize()
                 self.add_utxo(complete_id, tx_out)
                 rev_block.removable.append(complete_id)
             for i, tx_in in enumerate(tx.inputs):
-                complete_id = tx_in.prevout.hex
-                rev_block.old_txout.append([complete_id, self.get_utxo(complete_id)])
+                complete_id = tx_in.prevout.serialize()
+                if complete_id in view.created:  # created and spent in this block
+                    spent_created.add(complete_id)
+                else:
+                    rev_block.old_txout.append([complete_id, view.get(complete_id)])
                 self.remove_utxo(complete_id)
+        if spent_created:
+            rev_block.removable = [
+                id for id in rev_block.removable if id not in spent_created
+            ]
         return rev_block
 
     def validate_reverse_block(self, rev_block):  # TODO
@@ -132,3 +442,10 @@ class UTXOSet:
             self.remove_utxo(r_id)
         for id, utxo in rev_block.old_txout:
             self.add_utxo(id, utxo)
+
+    # reverses consecutive blocks starting from the tip, the coins they remove
+    # are loaded at once
+    def reverse_blocks(self, rev_blocks):
+        self.get_utxos([id for rev_block in rev_blocks for id in rev_block.removable])
+        for rev_block in rev_blocks:
+            self.reverse_block(rev_block)
@@ -125,21 +125,21 @@ def test_invalid_merkleroot():
 
 
 def test_rev_block_invalid_1():
-    rev_block = RevBlock("", [], [])
+    rev_block = RevBlock(b"", [], [])
     assert not rev_block.is_valid()
 
 
 def test_rev_block_invalid_2():
-    rev_block = RevBlock("", [], [])
-    rev_block.pow = "00" * 32
-    rev_block.old_txout = [[OutPoint("ff" * 32, 0).hex, TxOut(-1)]]
+    rev_block = RevBlock(b"", [], [])
+    rev_block.pow = b"\x00" * 32
+    rev_block.old_txout = [[OutPoint("ff" * 32, 0).serialize(), TxOut(-1)]]
     assert not rev_block.is_valid()
 
 
 def test_rev_block_invalid_3():
-    rev_block = RevBlock("", [], [])
-    rev_block.pow = "00" * 32
-    rev_block.old_txout = [[OutPoint("00" * 32, 0).hex, TxOut()]]
+    rev_block = RevBlock(b"", [], [])
+    rev_block.pow = b"\x00" * 32
+    rev_block.old_txout = [[OutPoint("00" * 32, 0).serialize(), TxOut()]]
     assert not rev_block.is_valid()
 
 
@@ -161,3 +161,40 @@ def test_double_spend():
     header.merkle_root = generate_merkle_root(block.transactions)
     header.previous_pow = "00" * 32
     assert not block.is_valid()
+
+
+def test_serialization_many_transactions():
+    coinbase = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    transactions = [coinbase]
+    for i in range(500):
+        tx_in = TxIn(OutPoint("ff" * 32, i), Script.from_hex("00030000bb"))
+        transactions.append(Tx([tx_in], [TxOut(i, Script())]))
+    header = BlockHeader("00" * 32, generate_merkle_root(transactions), 0)
+    block = Block(header, transactions)
+    data = block.serialize()
+    assert Block.deserialize(data) == block
+    assert Block.deserialize(memoryview(data)) == block
+
+
+def test_sealed_block():
+    coinbase = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    header = BlockHeader("00" * 32, generate_merkle_root([coinbase]), 0)
+    block = Block(header, [coinbase])
+    pow = header.pow
+    assert block.seal().sealed
+    assert header.pow == pow
+    assert Block.deserialize(block.serialize()) == block
+
+    header.nonce = 1
+    assert not header.sealed and not block.sealed
+    assert header.pow != pow
+    block.seal()
+    coinbase.inputs[0].unlocking_script = Script()
+    block.unseal()
+    assert not coinbase.sealed and not header.sealed
@@ -1,6 +1,601 @@
-from toykoin.core.blockchain import Blockchain
+from toykoin.core.blockchain import (
+    Blockchain,
+    BlockchainConfig,
+    BlockIndex,
+    IBD_DISTANCE,
+    OrphanPool,
+)
+from toykoin.core.block import Block, BlockHeader
+from toykoin.core.tx import Tx, TxIn, TxOut, OutPoint
+from toykoin.core.script import Script
+from toykoin.core.storage import SegmentStore
+from toykoin.core.utxo import UTXOSet
+from toykoin.core.utils import (
+    reset_blockchain,
+    get_schema_version,
+    set_schema_version,
+    generate_merkle_root,
+)
+from toykoin.core.pow import block_work
+
+import toykoin.core.blockchain
+import toykoin.core.utxo
+
+import os
+import pytest
+import shutil
+import sqlite3
 
 
 def test_double_blockchain():
     Blockchain()
     Blockchain()
+    reset_blockchain()
+
+
+def test_header_migration():
+    base_dir = os.path.join(os.path.expanduser("~"), ".toykoin", "regtest")
+    os.makedirs(base_dir, exist_ok=True)
+    db = sqlite3.connect(os.path.join(base_dir, "chainstate.sqlite"))
+    db.execute("CREATE TABLE header (pow, previous_pow, id)")
+    db.execute("INSERT INTO header VALUES (?, ?, ?)", ("aa" * 32, "00" * 32, 0))
+    db.execute("INSERT INTO header VALUES (?, ?, ?)", ("bb" * 32, "aa" * 32, 1))
+    db.commit()
+    db.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_last_blocks(2) == [
+        (b"\xbb" * 32, b"\xaa" * 32, 1),
+        (b"\xaa" * 32, b"\x00" * 32, 0),
+    ]
+    assert blockchain.get_block(b"\xaa" * 32) == (b"\xaa" * 32, b"\x00" * 32, 0)
+    assert blockchain.get_chainwork(b"\xbb" * 32) == block_work(
+        b"\xaa" * 32
+    ) + block_work(b"\xbb" * 32)
+
+    reset_blockchain()
+
+
+def test_fresh_schema():
+    blockchain = Blockchain()
+    fresh = blockchain.db.execute("PRAGMA table_info(header)").fetchall()
+    assert get_schema_version(blockchain.cursor, "header") == 3
+    blockchain.close()
+    reset_blockchain()
+
+    # the migrations of an old table end with the same schema
+    base_dir = os.path.join(os.path.expanduser("~"), ".toykoin", "regtest")
+    os.makedirs(base_dir, exist_ok=True)
+    db = sqlite3.connect(os.path.join(base_dir, "chainstate.sqlite"))
+    db.execute("CREATE TABLE header (pow, previous_pow, id)")
+    db.commit()
+    db.close()
+    blockchain = Blockchain()
+    assert blockchain.db.execute("PRAGMA table_info(header)").fetchall() == fresh
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_chainwork_backfill():
+    base_dir = os.path.join(os.path.expanduser("~"), ".toykoin", "regtest")
+    os.makedirs(base_dir, exist_ok=True)
+    db = sqlite3.connect(os.path.join(base_dir, "chainstate.sqlite"))
+    cursor = db.cursor()
+    cursor.execute("BEGIN")
+    get_schema_version(cursor, "header")
+    cursor.execute(
+        "CREATE TABLE header (pow BLOB PRIMARY KEY, "
+        "previous_pow BLOB NOT NULL, id INTEGER NOT NULL) WITHOUT ROWID"
+    )
+    cursor.execute("CREATE UNIQUE INDEX header_id ON header (id)")
+    headers = [(bytes([i + 1]) * 32, bytes([i]) * 32, i) for i in range(10)]
+    cursor.executemany("INSERT INTO header VALUES (?, ?, ?)", headers)
+    set_schema_version(cursor, "header", 1)
+    db.commit()
+    db.close()
+
+    blockchain = Blockchain()
+    chainwork = 0
+    for pow, previous_pow, id in headers:
+        chainwork += block_work(pow)
+        assert blockchain.get_chainwork(pow) == chainwork
+    assert blockchain.get_last_blocks()[0] == headers[-1]
+    assert blockchain.get_chainwork(b"\xff" * 32) == 0
+
+    reset_blockchain()
+
+
+def test_block_index():
+    index = BlockIndex()
+    for i in range(1000):
+        index.push(i.to_bytes(32, "big"), (i - 1).to_bytes(32, "big", signed=True), i)
+    index.commit()
+    tip = index.tip
+    assert tip.height == 999 and len(index) == 1000
+    for height in [0, 1, 2, 511, 512, 998, 999]:
+        entry = index.chain[height]
+        assert entry.height == height and index.get(entry.pow) is entry
+    assert index.get(index.chain[700].pow).previous_pow == index.chain[699].pow
+
+    # changes are undone by rollback
+    index.pop()
+    index.push(b"\xee" * 32, index.tip.pow, 0)
+    index.rollback()
+    assert index.tip is tip and index.get(tip.pow) is tip
+    assert index.get(b"\xee" * 32) is None
+
+
+def test_block_index_files():
+    index = BlockIndex()
+    for i in range(4):  # two blocks for each file
+        position = (i // 2, i % 2, 1)
+        index.push(bytes([i]) * 32, bytes([i - 1 & 255]) * 32, i, position, position)
+    index.commit()
+    assert index.file_entries("position", 0) == index.chain[:2]
+    assert index.file_entries("rev_position", 1) == index.chain[2:]
+
+    tip = index.pop()
+    index.push(b"\xee" * 32, index.tip.pow, 0, (2, 0, 1))
+    assert index.file_entries("position", 1) == index.chain[2:3]
+    assert index.file_entries("position", 2) == index.chain[3:]
+    index.rollback()
+    assert index.file_entries("position", 1) == [index.chain[2], tip]
+    assert index.file_entries("position", 2) == []
+
+    entries = index.file_entries("position", 0)
+    index.prune_file("position", 0)
+    assert all(entry.position is None for entry in entries)
+    assert entries[0].rev_position == (0, 0, 1)
+    assert index.file_entries("position", 0) == []
+
+
+def test_index_without_sql():
+    blockchain = Blockchain()
+    coinbase = Tx([TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10 ** 10, Script())])
+    header = BlockHeader("00" * 32, generate_merkle_root([coinbase]), 0)
+    assert blockchain.add_blocks([Block(header, [coinbase])])
+
+    blockchain = Blockchain()  # the index is loaded from the header table
+    cursor = blockchain.cursor
+    blockchain.cursor = None
+    assert blockchain.get_last_blocks()[0] == (header.hash, b"\x00" * 32, 0)
+    assert blockchain.get_block(header.hash)[2] == 0
+    assert blockchain.get_chainwork(header.hash) == block_work(header.hash)
+    blockchain.cursor = cursor
+
+    reset_blockchain()
+
+
+def test_segment_store(tmp_path):
+    store = SegmentStore(str(tmp_path), "blk", max_file_size=100)
+    positions = [store.append(bytes([i]) * 40) for i in range(5)]
+    assert [position[0] for position in positions] == [0, 0, 1, 1, 2]
+    assert positions[3] == (1, 40, 40)
+    for i, position in enumerate(positions):
+        assert store.read(position) == bytes([i]) * 40
+    store.close()
+
+    store = SegmentStore(str(tmp_path), "blk", max_file_size=100)
+    assert store.append(b"\xff") == (2, 40, 1)  # appends to the last segment
+    assert store.read(positions[1]) == b"\x01" * 40
+    store.close()
+
+
+def test_block_files_conversion():
+    blockchain = Blockchain()
+    coinbase = Tx([TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10 ** 10, Script())])
+    header = BlockHeader("00" * 32, generate_merkle_root([coinbase]), 0)
+    block = Block(header, [coinbase])
+    assert blockchain.add_blocks([block])
+    assert blockchain.read_block(header.hash) == block
+    rev_block = blockchain.rev_blocks.read(blockchain.index.tip.rev_position)
+    blockchain.blocks.close()
+    blockchain.rev_blocks.close()
+
+    # back to one file per block and to the version 2 header table
+    base_dir = blockchain.base_dir
+    for directory, extension, data in [
+        ("blocks", ".block", block.serialize()),
+        ("rev", ".rev", rev_block),
+    ]:
+        shutil.rmtree(os.path.join(base_dir, directory))
+        os.makedirs(os.path.join(base_dir, directory))
+        with open(os.path.join(base_dir, directory, header.pow + extension), "wb") as f:
+            f.write(data)
+    cursor = blockchain.db.cursor()
+    cursor.execute("BEGIN")
+    cursor.execute(
+        "CREATE TABLE header_v2 AS SELECT pow, previous_pow, id, chainwork FROM header"
+    )
+    cursor.execute("DROP TABLE header")
+    cursor.execute("ALTER TABLE header_v2 RENAME TO header")
+    set_schema_version(cursor, "header", 2)
+    blockchain.db.commit()
+
+    blockchain = Blockchain()
+    assert blockchain.read_block(header.hash) == block
+    assert os.listdir(os.path.join(base_dir, "blocks")) == ["blk00000.dat"]
+    assert os.listdir(os.path.join(base_dir, "rev")) == ["rev00000.dat"]
+
+    reset_blockchain()
+
+
+def coinbase_chain(n, previous_pow="00" * 32, tag=0):
+    blocks = []
+    for i in range(n):
+        coinbase = Tx(
+            [
+                TxIn(
+                    OutPoint("00" * 32, 0),
+                    Script.from_hex("00040000%02x%02x" % (tag, i)),
+                )
+            ],
+            [TxOut(10 ** 10, Script())],
+        )
+        header = BlockHeader(previous_pow, generate_merkle_root([coinbase]), 0)
+        blocks.append(Block(header, [coinbase]))
+        previous_pow = header.pow
+    return blocks
+
+
+def test_commit_per_block():
+    blockchain = Blockchain(profile="safe")
+    statements = []
+    blockchain.db.set_trace_callback(statements.append)
+    blocks = coinbase_chain(3)
+    invalid = coinbase_chain(4)[3]  # its parent is not in the chain
+    assert blockchain.add_blocks(blocks[:2] + [invalid] + blocks[2:])
+    assert blockchain.get_last_blocks()[0][0] == blocks[2].header.hash
+    assert statements.count("COMMIT") == 3
+    assert blockchain.db.execute("PRAGMA synchronous").fetchone() == (2,)  # FULL
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_group_commit():
+    blockchain = Blockchain(profile="ibd")
+    statements = []
+    blockchain.db.set_trace_callback(statements.append)
+    blocks = coinbase_chain(4)
+    assert blockchain.add_blocks(blocks[:2])
+    assert blockchain.add_blocks(blocks[2:] + coinbase_chain(6)[5:])
+    assert blockchain.get_last_blocks()[0][0] == blocks[3].header.hash
+    assert statements.count("COMMIT") == 0
+    assert blockchain.db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert blockchain.db.execute("PRAGMA synchronous").fetchone() == (0,)  # OFF
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_last_blocks()[0][0] == blocks[3].header.hash
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_automatic_profile():
+    blockchain = Blockchain()
+    assert blockchain.profile.name == "safe"
+    blockchain.set_best_known_height(IBD_DISTANCE + 2)
+    assert blockchain.profile.name == "ibd"
+    blocks = coinbase_chain(3)
+    assert blockchain.add_blocks(blocks)
+    assert blockchain.profile.name == "safe"  # caught up
+    assert not blockchain.db.in_transaction
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_utxo_db_merge():
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(coinbase_chain(2))
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    base_dir = blockchain.base_dir
+    # the coins go back to their own database
+    utxo_set = UTXOSet(base_dir)
+    utxo_set.cursor.executemany(
+        "INSERT INTO utxo VALUES (?, ?, ?)",
+        blockchain.db.execute("SELECT * FROM utxo").fetchall(),
+    )
+    utxo_set.commit()
+    utxo_set.close()
+    blockchain.db.execute("DELETE FROM utxo")
+    blockchain.db.execute("DELETE FROM best_block")
+    blockchain.db.commit()
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+    assert not os.path.exists(os.path.join(base_dir, "utxo_set.sqlite"))
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_utxo_db_merge_repair():
+    blocks = coinbase_chain(3)
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(blocks[:2])
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    assert blockchain.add_blocks(blocks[2:])
+    entry = blockchain.index.tip
+    base_dir = blockchain.base_dir
+    # the old layout crashed after committing the coins of the last block,
+    # before its header, whose files were already written
+    pow = entry.pow.hex()
+    with open(os.path.join(base_dir, "blocks", pow + ".block"), "wb") as f:
+        f.write(blockchain.blocks.read(entry.position))
+    with open(os.path.join(base_dir, "rev", pow + ".rev"), "wb") as f:
+        f.write(blockchain.rev_blocks.read(entry.rev_position))
+    utxo_set = UTXOSet(base_dir)
+    utxo_set.cursor.executemany(
+        "INSERT INTO utxo VALUES (?, ?, ?)",
+        blockchain.db.execute("SELECT * FROM utxo").fetchall(),
+    )
+    utxo_set.commit()
+    utxo_set.close()
+    blockchain.db.execute("DELETE FROM utxo")
+    blockchain.db.execute("DELETE FROM best_block")
+    blockchain.db.execute("DELETE FROM header WHERE pow = ?", (entry.pow,))
+    blockchain.db.commit()
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_last_blocks()[0][0] == blocks[1].header.hash
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+    assert not os.path.exists(os.path.join(base_dir, "blocks", pow + ".block"))
+    # the coins of the tip are missing, they do not belong to this chain
+    blockchain.db.execute("DELETE FROM utxo")
+    blockchain.db.execute("DELETE FROM best_block")
+    blockchain.db.commit()
+    utxo_set = UTXOSet(base_dir)
+    utxo_set.close()
+    blockchain.close()
+    with pytest.raises(Exception):
+        Blockchain()
+
+    reset_blockchain()
+
+
+def test_best_block_repair_pruned():
+    blocks = coinbase_chain(3)
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(blocks)
+    blockchain.db.execute("UPDATE best_block SET pow = ?", (blocks[0].header.hash,))
+    blockchain.db.execute(
+        "UPDATE header SET block_file = NULL, block_offset = NULL, "
+        "block_length = NULL WHERE pow = ?",
+        (blocks[1].header.hash,),
+    )
+    blockchain.db.commit()
+    blockchain.close()
+    with pytest.raises(Exception):
+        Blockchain()
+
+    reset_blockchain()
+
+
+def test_best_block_repair():
+    blocks = coinbase_chain(3)
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(blocks[:1])
+    coins = blockchain.db.execute("SELECT * FROM utxo").fetchall()
+    assert blockchain.add_blocks(blocks[1:])
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    # the coins are left as they were after the first block
+    blockchain.db.execute("DELETE FROM utxo")
+    blockchain.db.executemany("INSERT INTO utxo VALUES (?, ?, ?)", coins)
+    blockchain.db.execute("UPDATE best_block SET pow = ?", (blocks[0].header.hash,))
+    blockchain.db.commit()
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+    assert blockchain.db.execute("SELECT pow FROM best_block").fetchone() == (
+        blocks[2].header.hash,
+    )
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_reorg(monkeypatch):
+    monkeypatch.setattr(toykoin.core.blockchain, "block_work", lambda pow: 1)
+    main = coinbase_chain(4)
+    expected = Blockchain("expected")
+    branch = coinbase_chain(3, main[1].header.pow, tag=1)
+    assert expected.add_blocks(main[:2] + branch)
+    expected_utxos = expected.get_utxo_set().get_utxo_list()
+    expected.close()
+    reset_blockchain("expected")
+
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(main)
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    statements = []
+    blockchain.db.set_trace_callback(statements.append)
+
+    # the branch does not have more work, nothing is disconnected
+    assert not blockchain.add_blocks(branch[:2])
+    assert not any(statement.startswith("DELETE") for statement in statements)
+
+    # the block that would give more work to the branch is invalid
+    invalid = Block(BlockHeader(branch[2].header.previous_pow, "00" * 32, 0), [])
+    assert not blockchain.add_blocks(branch[:2] + [invalid])
+    assert blockchain.get_last_blocks()[0][0] == main[3].header.hash
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+
+    assert blockchain.add_blocks(branch)
+    assert blockchain.get_last_blocks()[0][0] == branch[2].header.hash
+    assert blockchain.get_chainwork(branch[2].header.hash) == 5
+    assert blockchain.get_utxo_set().get_utxo_list() == expected_utxos
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_prune_depth(monkeypatch):
+    monkeypatch.setattr(toykoin.core.blockchain, "MIN_BLOCKS_TO_KEEP", 2)
+    blockchain = Blockchain(prune_depth=3)
+    blockchain.blocks.max_file_size = 1  # one block for each file
+    blockchain.rev_blocks.max_file_size = 1
+    blocks = coinbase_chain(8)
+    assert blockchain.add_blocks(blocks)
+
+    # the blocks deeper than 3 are pruned, heights 0 to 4
+    assert blockchain.prune_height == 4
+    assert blockchain.blocks.files() == [5, 6, 7]
+    assert blockchain.rev_blocks.files() == [5, 6, 7]
+    assert blockchain.is_pruned(blocks[4].header.hash)
+    assert blockchain.read_block(blocks[4].header.hash) is None
+    assert blockchain.read_block(blocks[5].header.hash) == blocks[5]
+
+    # a fork below the prune height cannot be reorganized
+    monkeypatch.setattr(toykoin.core.blockchain, "block_work", lambda pow: 1)
+    branch = coinbase_chain(6, blocks[2].header.pow, tag=1)
+    assert not blockchain.add_blocks(branch)
+    assert blockchain.get_last_blocks()[0][0] == blocks[7].header.hash
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.prune_height == 4
+    assert blockchain.is_pruned(blocks[0].header.hash)
+    assert not blockchain.is_pruned(blocks[7].header.hash)
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_prune_size(monkeypatch):
+    monkeypatch.setattr(toykoin.core.blockchain, "MIN_BLOCKS_TO_KEEP", 3)
+    blocks = coinbase_chain(10)
+    block_size = len(blocks[0].serialize())
+    blockchain = Blockchain(prune_size=6 * block_size)
+    blockchain.blocks.max_file_size = 1
+    blockchain.rev_blocks.max_file_size = 1
+    assert blockchain.add_blocks(blocks)
+    assert blockchain.blocks.size() + blockchain.rev_blocks.size() <= 6 * block_size
+    assert blockchain.read_block(blocks[-1].header.hash) == blocks[-1]
+    # the last blocks are kept even if they are over the budget
+    budget = Blockchain("budget", prune_size=1)
+    budget.blocks.max_file_size = 1
+    budget.rev_blocks.max_file_size = 1
+    assert budget.add_blocks(blocks)
+    assert budget.blocks.files() == [7, 8, 9]
+    blockchain.close()
+    budget.close()
+
+    reset_blockchain()
+    reset_blockchain("budget")
+
+
+def test_assume_valid(monkeypatch):
+    # every script execution fails, only the assumed valid blocks can connect
+    monkeypatch.setattr(toykoin.core.utxo, "verify_scripts", lambda *args: False)
+    blocks = coinbase_chain(5)
+    config = BlockchainConfig(blocks[2].header.pow)
+    blockchain = Blockchain(config=config)
+    assert blockchain.add_blocks(blocks)
+    assert blockchain.get_last_blocks()[0][0] == blocks[2].header.hash
+    assert not blockchain.assumed_valid
+    blockchain.close()
+    reset_blockchain()
+
+    # the ancestors are known from the headers before the blocks arrive
+    blockchain = Blockchain(config=config)
+    blockchain.add_headers([block.header for block in blocks])
+    for block in blocks[:3]:
+        assert blockchain.add_blocks([block])
+    assert not blockchain.add_blocks(blocks[3:])
+    blockchain.close()
+    reset_blockchain()
+
+    # a block that is not an ancestor is fully verified
+    blockchain = Blockchain(
+        config=BlockchainConfig(coinbase_chain(5, tag=1)[2].header.pow)
+    )
+    assert not blockchain.add_blocks(blocks)
+    blockchain.close()
+    reset_blockchain()
+
+    # the links kept waiting for an assume_valid that never comes are bounded
+    monkeypatch.setattr(toykoin.core.blockchain, "ASSUME_VALID_MAX_HEADERS", 3)
+    blockchain = Blockchain(config=BlockchainConfig("ff" * 32))
+    blockchain.add_headers([block.header for block in blocks])
+    assert list(blockchain.headers) == [block.header.hash for block in blocks[2:]]
+    blockchain.add_headers([block.header for block in coinbase_chain(5, tag=2)])
+    assert len(blockchain.headers) == 3 and not blockchain.assumed_valid
+    blockchain.close()
+    reset_blockchain()
+
+    config.check_all_scripts = True
+    blockchain = Blockchain(config=config)
+    assert not blockchain.add_blocks(blocks)
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_orphan_pool():
+    blocks = coinbase_chain(4)
+    fork = coinbase_chain(2, blocks[1].header.pow, tag=1)
+    size = len(blocks[0].serialize())
+    orphans = OrphanPool(max_count=4, max_size=10 * size)
+    for block in blocks[1:] + fork:  # the oldest one is evicted
+        orphans.add(block)
+    assert len(orphans) == 4 and blocks[1].header.hash not in orphans
+    chains = orphans.pop_descendants(blocks[1].header.hash)
+    assert chains == [blocks[2:], fork]
+    assert len(orphans) == 0 and orphans.size == 0 and not orphans.children
+
+    orphans = OrphanPool(max_size=2 * size)
+    for block in blocks:
+        orphans.add(block)
+    assert list(orphans.blocks) == [block.header.hash for block in blocks[2:]]
+
+
+def test_out_of_order_blocks():
+    blocks = coinbase_chain(6)
+    blockchain = Blockchain()
+    assert not blockchain.add_blocks(blocks[4:])
+    assert not blockchain.add_blocks([blocks[2]])
+    assert not blockchain.add_blocks([blocks[1]])
+    assert len(blockchain.orphans) == 4
+    assert blockchain.add_blocks([blocks[0]])  # 1 and 2 follow, 4 and 5 wait
+    assert blockchain.get_last_blocks()[0][0] == blocks[2].header.hash
+    assert len(blockchain.orphans) == 2
+    assert blockchain.add_blocks([blocks[3]])
+    assert blockchain.get_last_blocks()[0][0] == blocks[5].header.hash
+    assert len(blockchain.orphans) == 0
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_orphan_branches(monkeypatch):
+    monkeypatch.setattr(toykoin.core.blockchain, "block_work", lambda pow: 1)
+    blocks = coinbase_chain(3)
+    fork = coinbase_chain(2, blocks[0].header.pow, tag=1)
+    for first, second in [(fork, blocks[1:]), (blocks[1:], fork)]:
+        blockchain = Blockchain()
+        assert not blockchain.add_blocks(first)
+        assert not blockchain.add_blocks(second)
+        assert blockchain.add_blocks(blocks[:1])
+        # the branches have the same work, the first one received is kept
+        assert blockchain.get_last_blocks()[0][0] == first[-1].header.hash
+        blockchain.close()
+
+        reset_blockchain()
+
+
+def test_cache_size():
+    blockchain = Blockchain(cache_size=2 ** 10)
+    assert blockchain.get_utxo_set().cache.max_size == 2 ** 10
+    assert blockchain.add_blocks(coinbase_chain(20))
+    assert blockchain.get_utxo_set().cache.size <= 2 ** 10
+    assert len(blockchain.get_utxo_set().get_utxo_list()) == 20
+    blockchain.close()
+
+    reset_blockchain()
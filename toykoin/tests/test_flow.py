@@ -1,6 +1,13 @@
 from toykoin.core.tx import Tx, TxIn, TxOut, OutPoint
 from toykoin.core.block import Block, BlockHeader
-from toykoin.core.script import Script
+from toykoin.core.script import (
+    Script,
+    signature_cache,
+    script_cost,
+    MAX_SCRIPT_COST,
+    MAX_BLOCK_COST,
+    OP_HASH256,
+)
 from toykoin.core.blockchain import Blockchain
 from toykoin.core.utils import generate_merkle_root, reset_blockchain
 from toykoin.core.pow import calculate_nonce
@@ -11,9 +18,12 @@ from toykoin.core.sign_tx import (
     lock_p2pkh,
     unlock_p2pk,
     unlock_p2pkh,
+    sign_tx,
 )
 from toykoin.core.sighash import sighash_all
 
+import toykoin.core.utxo
+
 import pytest
 
 
@@ -34,7 +44,7 @@ def test_flow_1():
 
     blockchain = Blockchain()
     blockchain._add_block(origin)
-    assert blockchain.get_last_blocks()[0][0] == origin.header.pow
+    assert blockchain.get_last_blocks()[0][0] == origin.header.hash
 
     coinbase_1 = Tx(
         [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000bb"))],
@@ -45,7 +55,7 @@ def test_flow_1():
     )
     block_1 = Block(block_1_header, [coinbase_1])
     blockchain._add_block(block_1)
-    assert blockchain.get_last_blocks()[0][0] == block_1.header.pow
+    assert blockchain.get_last_blocks()[0][0] == block_1.header.hash
 
     reset_blockchain()
 
@@ -219,7 +229,7 @@ def test_flow_7():
 
     blockchain = Blockchain()
     blockchain._add_block(origin)
-    assert blockchain.get_last_blocks()[0][0] == origin.header.pow
+    assert blockchain.get_last_blocks()[0][0] == origin.header.hash
 
     coinbase_1 = Tx(
         [TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10 ** 10, Script())]
@@ -473,13 +483,13 @@ def test_flow_12():
     block_4 = Block(block_4_header, block_4_transactions)
 
     assert blockchain.add_blocks([block_3, block_4])
-    assert blockchain.get_last_blocks()[0][0] == block_3.header.pow
+    assert blockchain.get_last_blocks()[0][0] == block_3.header.hash
 
     block_4.header = BlockHeader(
         block_3.header.pow, generate_merkle_root(block_4_transactions), 0
     )
     assert blockchain.add_blocks([block_3, block_4])
-    assert blockchain.get_last_blocks()[0][0] == block_4.header.pow
+    assert blockchain.get_last_blocks()[0][0] == block_4.header.hash
 
     reset_blockchain()
 
@@ -496,7 +506,7 @@ def test_flow_13():
 
     blockchain = Blockchain()
     blockchain._add_block(origin)
-    assert blockchain.get_last_blocks()[0][0] == origin.header.pow
+    assert blockchain.get_last_blocks()[0][0] == origin.header.hash
 
     coinbase_1 = Tx(
         [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
@@ -634,3 +644,191 @@ def test_flow_16():
     assert blockchain.add_blocks([block_1])
 
     reset_blockchain()
+
+
+def test_flow_17():
+    """
+    This MUST NOT fail
+    A transaction spends an output created earlier in the same block, reversing
+    the block restores the previous utxo set
+    """
+
+    blockchain = Blockchain()
+
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10 ** 10, Script())]
+    )
+    origin_header = BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0)
+    origin = Block(origin_header, [coinbase_0])
+    assert blockchain.add_blocks([origin])
+    old_utxo_list = blockchain.get_utxo_set().get_utxo_list()
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    tx_1 = Tx([TxIn(OutPoint(coinbase_0.txid, 0), Script())], [TxOut(10 ** 10)])
+    tx_2 = Tx([TxIn(OutPoint(tx_1.txid, 0), Script())], [TxOut(10 ** 10)])
+    block_1_transactions = [coinbase_1, tx_1, tx_2]
+    block_1_header = BlockHeader(
+        origin.header.pow, generate_merkle_root(block_1_transactions), 0
+    )
+    block_1 = Block(block_1_header, block_1_transactions)
+    rev_block = blockchain._add_block(block_1)
+    assert OutPoint(tx_1.txid, 0).serialize() not in rev_block.removable
+    assert blockchain.get_utxo_set().get_utxo_list() == sorted(
+        [
+            (OutPoint(coinbase_1.txid, 0).serialize(),),
+            (OutPoint(tx_2.txid, 0).serialize(),),
+        ]
+    )
+
+    blockchain._reverse_block(rev_block)
+    assert blockchain.get_utxo_set().get_utxo_list() == old_utxo_list
+
+    # the spending transaction must come after the one it spends
+    block_2_transactions = [coinbase_1, tx_2, tx_1]
+    block_2_header = BlockHeader(
+        origin.header.pow, generate_merkle_root(block_2_transactions), 0
+    )
+    block_2 = Block(block_2_header, block_2_transactions)
+    assert not blockchain.add_blocks([block_2])
+
+    reset_blockchain()
+
+
+def test_flow_18():
+    """
+    This MUST NOT fail
+    The scripts of the block are verified on a process pool
+    """
+
+    blockchain = Blockchain(script_workers=2)
+
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())],
+        [TxOut(10 ** 8, lock_p2pkh(pubkey_hash_from_prvkey(i))) for i in range(1, 41)],
+    )
+    origin_header = BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0)
+    origin = Block(origin_header, [coinbase_0])
+    assert blockchain.add_blocks([origin])
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    tx = Tx([TxIn(OutPoint(coinbase_0.txid, i)) for i in range(40)], [TxOut(10 ** 5)])
+    sighash = sighash_all(tx)
+    for i, tx_in in enumerate(tx.inputs):
+        tx_in.unlocking_script = unlock_p2pkh(sighash, i + 1)
+    # the last input is signed by the wrong key
+    invalid_tx = Tx(tx.inputs[:-1] + [TxIn(tx.inputs[-1].prevout)], tx.outputs)
+    invalid_tx.inputs[-1].unlocking_script = unlock_p2pkh(sighash, 1)
+
+    for transactions, valid in [
+        ([coinbase_1, invalid_tx], False),
+        ([coinbase_1, tx], True),
+    ]:
+        header = BlockHeader(origin.header.pow, generate_merkle_root(transactions), 0)
+        assert blockchain.add_blocks([Block(header, transactions)]) == valid
+    blockchain.get_utxo_set().close()
+
+    reset_blockchain()
+
+
+def test_flow_19():
+    """
+    This MUST NOT fail
+    The signatures checked when the transaction was first seen are not verified
+    again when its block is connected
+    """
+
+    blockchain = Blockchain()
+
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())],
+        [TxOut(10 ** 10, lock_p2pkh(pubkey_hash_from_prvkey(1)))],
+    )
+    origin_header = BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0)
+    origin = Block(origin_header, [coinbase_0])
+    assert blockchain.add_blocks([origin])
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    tx = Tx([TxIn(OutPoint(coinbase_0.txid, 0))], [TxOut(10 ** 10 - 100)])
+    tx.inputs[0].unlocking_script = unlock_p2pkh(sighash_all(tx), 1)
+    assert blockchain.get_utxo_set().validate_transaction(tx)  # mempool
+
+    misses = signature_cache.misses
+    hits = signature_cache.hits
+    block_1_transactions = [coinbase_1, tx]
+    block_1_header = BlockHeader(
+        origin.header.pow, generate_merkle_root(block_1_transactions), 0
+    )
+    assert blockchain.add_blocks([Block(block_1_header, block_1_transactions)])
+    assert signature_cache.misses == misses
+    assert signature_cache.hits == hits + 1
+
+    reset_blockchain()
+
+
+def test_flow_20():
+    """
+    This MUST NOT fail
+    The cost of the scripts of each transaction is measured, a script or a
+    block over its budget is rejected
+    """
+
+    blockchain = Blockchain()
+
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())],
+        [TxOut(10 ** 8, lock_p2pkh(pubkey_hash_from_prvkey(i))) for i in range(1, 11)],
+    )
+    origin_header = BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0)
+    origin = Block(origin_header, [coinbase_0])
+    assert blockchain.add_blocks([origin])
+    utxo_set = blockchain.get_utxo_set()
+
+    tx = Tx([TxIn(OutPoint(coinbase_0.txid, i)) for i in range(10)], [TxOut(10 ** 5)])
+    sign_tx(tx, range(1, 11))
+    costs = {}
+    assert utxo_set.validate_transaction(tx, costs=costs)
+    cost, sigops = costs[tx.hash]
+    assert sigops == 10
+    assert (
+        cost
+        == 10
+        * script_cost(
+            tx.inputs[0].unlocking_script + coinbase_0.outputs[0].locking_script
+        )[0]
+    )
+
+    # a script over MAX_SCRIPT_COST is invalid even if it would succeed
+    expensive_tx = Tx([TxIn(OutPoint(coinbase_0.txid, 0))], [TxOut(10 ** 5)])
+    sign_tx(expensive_tx, [1])
+    hashes = [[0x10, OP_HASH256, b"\x00"]] * (MAX_SCRIPT_COST // 4)
+    expensive_tx.inputs[0].unlocking_script.expressions += hashes
+    assert expensive_tx.inputs[0].unlocking_script.is_valid()
+    assert not utxo_set.validate_transaction(expensive_tx)
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    transactions = [coinbase_1, tx]
+    header = BlockHeader(origin.header.pow, generate_merkle_root(transactions), 0)
+    block = Block(header, transactions)
+    toykoin.core.utxo.MAX_BLOCK_COST = cost - 1
+    try:
+        assert not blockchain.add_blocks([block])
+    finally:
+        toykoin.core.utxo.MAX_BLOCK_COST = MAX_BLOCK_COST
+    costs = {}
+    assert utxo_set.validate_block(block, costs=costs)
+    assert costs == {tx.hash: (cost, sigops)}
+    assert blockchain.add_blocks([block])
+
+    reset_blockchain()
@@ -0,0 +1,160 @@
+from toykoin.core.block import Block
+from toykoin.core.blockchain import Blockchain
+from toykoin.core.importer import (
+    export_blocks,
+    import_blocks,
+    read_block_file,
+    read_block_file_headers,
+    reindex,
+    write_block_file,
+)
+from toykoin.core.utils import reset_blockchain
+from toykoin.core.utxo import UTXOSet
+from toykoin.tests.test_blockchain import coinbase_chain
+
+import pytest
+
+
+def test_block_file(tmp_path):
+    blocks = coinbase_chain(3)
+    path = tmp_path / "blocks.dat"
+    write_block_file(path, blocks)
+    assert list(read_block_file(path)) == [block.serialize() for block in blocks]
+    assert list(read_block_file_headers(path)) == [block.header for block in blocks]
+
+
+def test_import_export(tmp_path):
+    blocks = coinbase_chain(5)
+    path = tmp_path / "blocks.dat"
+    write_block_file(path, blocks)
+
+    for workers in [0, 2]:
+        blockchain = Blockchain(profile="safe")
+        reports = []
+        stats = import_blocks(
+            blockchain, read_block_file(path), workers, reports.append
+        )
+        assert stats.read == stats.checked == stats.connected == 5
+        assert reports[-1] is stats
+        assert blockchain.get_last_blocks()[0][0] == blocks[4].header.hash
+        assert blockchain.profile.name == "safe"
+        assert not blockchain.db.in_transaction
+        export_blocks(blockchain, tmp_path / "exported.dat")
+        assert (tmp_path / "exported.dat").read_bytes() == path.read_bytes()
+        blockchain.close()
+
+        reset_blockchain()
+
+
+def test_import_checks_once(tmp_path, monkeypatch):
+    blocks = coinbase_chain(5)
+    path = tmp_path / "blocks.dat"
+    write_block_file(path, blocks)
+
+    calls = []
+    is_valid = Block.is_valid
+
+    def counted_is_valid(block):
+        calls.append(block.header.hash)
+        return is_valid(block)
+
+    monkeypatch.setattr(Block, "is_valid", counted_is_valid)
+    blockchain = Blockchain()
+    stats = import_blocks(blockchain, read_block_file(path))
+    assert stats.connected == 5
+    assert calls == [block.header.hash for block in blocks]
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_import_invalid_block(tmp_path):
+    blocks = coinbase_chain(5)
+    blocks[2].transactions[0].outputs[0].value += 1  # wrong merkle root
+    path = tmp_path / "blocks.dat"
+    write_block_file(path, blocks)
+
+    blockchain = Blockchain()
+    stats = import_blocks(blockchain, read_block_file(path))
+    assert stats.checked == stats.connected == 2
+    assert blockchain.get_last_blocks()[0][0] == blocks[1].header.hash
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_import_source_error():
+    blocks = coinbase_chain(3)
+
+    def source():
+        yield blocks[0].serialize()
+        yield blocks[1].serialize()
+        raise OSError("unreadable block file")
+
+    for workers in [0, 2]:
+        blockchain = Blockchain()
+        with pytest.raises(OSError, match="unreadable"):
+            import_blocks(blockchain, source(), workers)
+        assert blockchain.get_last_blocks()[0][0] == blocks[1].header.hash
+        assert blockchain.profile.name != "ibd"
+        blockchain.close()
+
+        reset_blockchain()
+
+
+def test_reindex():
+    blocks = coinbase_chain(4)
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(blocks)
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    old_files = blockchain.blocks.files()
+
+    stats = reindex(blockchain)
+    assert stats.connected == 4
+    assert blockchain.get_last_blocks()[0][0] == blocks[3].header.hash
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+    assert not set(old_files) & set(blockchain.blocks.files())
+    blockchain.close()
+
+    blockchain = Blockchain()
+    assert blockchain.get_last_blocks()[0][0] == blocks[3].header.hash
+    assert blockchain.read_block(blocks[0].header.hash) == blocks[0]
+    blockchain.close()
+
+    reset_blockchain()
+
+
+def test_reindex_failure(monkeypatch):
+    blocks = coinbase_chain(4)
+    blockchain = Blockchain()
+    assert blockchain.add_blocks(blocks)
+    utxos = blockchain.get_utxo_set().get_utxo_list()
+    old_files = blockchain.blocks.files()
+
+    add_block = UTXOSet.add_block
+
+    def fail_on_third_block(utxo_set, block, *args):
+        if block.header.hash == blocks[2].header.hash:
+            raise Exception
+        return add_block(utxo_set, block, *args)
+
+    monkeypatch.setattr(UTXOSet, "add_block", fail_on_third_block)
+    with pytest.raises(Exception):
+        reindex(blockchain)
+    assert blockchain.get_last_blocks()[0][0] == blocks[1].header.hash
+    assert set(old_files) <= set(blockchain.blocks.files())
+    blockchain.close()
+
+    # the next reindex starts again from the saved positions
+    monkeypatch.undo()
+    blockchain = Blockchain()
+    assert len(blockchain.get_reindex_positions()) == 4
+    stats = reindex(blockchain)
+    assert stats.connected == 4
+    assert blockchain.get_last_blocks()[0][0] == blocks[3].header.hash
+    assert blockchain.get_utxo_set().get_utxo_list() == utxos
+    assert blockchain.get_reindex_positions() == []
+    assert not set(old_files) & set(blockchain.blocks.files())
+    blockchain.close()
+
+    reset_blockchain()
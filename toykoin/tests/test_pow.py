@@ -1,9 +1,11 @@
-from toykoin.core.pow import calculate_nonce, work_from_chain
+from toykoin.core.pow import calculate_nonce, work_from_chain, block_work, Miner
 from toykoin.core.block import BlockHeader
 from toykoin.core.tx import Tx, TxIn, TxOut, OutPoint
 from toykoin.core.script import Script
 from toykoin.core.utils import generate_merkle_root
 
+import threading
+
 
 def test_mining():
     target = 16 ** 4
@@ -17,3 +19,54 @@ def test_mining():
     nonce = calculate_nonce(header, target)
     header.nonce = nonce
     assert work_from_chain([header.pow]) > target
+
+
+def is_valid_pow(header, target):
+    return int.from_bytes(header.hash, "big") * target < 2 ** 256
+
+
+def test_first_nonce():
+    target = 16 ** 3
+    header = BlockHeader("00" * 32, "11" * 32, 5)
+    nonce = calculate_nonce(header, target)
+    assert header.nonce == 5  # the header is not modified
+    for header.nonce in range(6, nonce):
+        assert not is_valid_pow(header, target)
+    header.nonce = nonce
+    assert is_valid_pow(header, target)
+
+
+def test_parallel_mining():
+    target = 16 ** 4
+    header = BlockHeader("00" * 32, "22" * 32, 0)
+    miner = Miner(workers=2, chunk_size=2 ** 10)
+    try:
+        header.nonce = miner.mine(header, target)
+    finally:
+        miner.close()
+    assert is_valid_pow(header, target)
+    nonce, header.nonce = header.nonce, 0
+    assert calculate_nonce(header, target, Miner(chunk_size=2 ** 10)) == nonce
+    assert miner.hashes > 0
+    assert miner.hashrate > 0
+
+
+def test_cancel_mining():
+    cancel = threading.Event()
+    cancel.set()
+    header = BlockHeader("00" * 32, "33" * 32, 0)
+    miner = Miner()
+    assert miner.mine(header, 2 ** 200, cancel) is None
+    assert miner.hashes == 0
+
+
+def test_exact_work():
+    pow = "00" * 16 + "ff" * 16
+    assert block_work(pow) == 2 ** 256 // (2 ** 128 - 1)
+    assert work_from_chain([pow] * 10 ** 3) == 10 ** 3 * block_work(pow)
+
+
+def test_float_target():
+    header = BlockHeader("00" * 32, "44" * 32, 0)
+    header.nonce = calculate_nonce(header, 2.5 * 16 ** 3)
+    assert is_valid_pow(header, 2.5 * 16 ** 3)
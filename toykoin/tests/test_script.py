@@ -1,4 +1,21 @@
-from toykoin.core.script import Script
+from toykoin.core.script import (
+    Script,
+    verify_script,
+    verify_scripts,
+    find_invalid_signatures,
+    signature_cache,
+    SignatureCache,
+    compile_script,
+    CompiledScriptCache,
+    compiled_scripts,
+    script_cost,
+    check_cost,
+    OP_HASH256,
+    OP_PUSHDATA,
+    OP_EQUAL,
+    OP_SHNORR_CHECKSIG,
+    OP_VERIFY,
+)
 from toykoin.core.sign_tx import (
     lock_p2pk,
     unlock_p2pk,
@@ -8,10 +25,18 @@ from toykoin.core.sign_tx import (
     pubkey_hash_from_prvkey,
 )
 
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+
 
 def test_serialization():
     assert Script() == Script.from_hex("")
     assert Script.from_hex(Script().hex) == Script()
+    # a malformed length is parsed as it always was, a zero length is refused
+    script = Script.deserialize(b"\x00\x01\x05\x06\x00\x02\x07\x08")
+    assert script.expressions == [[5, 6, b""], [2, 7, b"\x08"]]
+    with pytest.raises(Exception):
+        Script.deserialize(b"\x00\x00\x05\x06")
 
 
 def test_valid_schnorr():
@@ -25,3 +50,180 @@ def test_invalid_schnorr():
     false_sighash = bytes.fromhex("aa" * 32)
     script = unlock_p2pk(sighash, 1) + lock_p2pk(pubkey_from_prvkey(1))
     assert not script.execute(memory={0x100: false_sighash})
+
+
+def test_parallel_verification():
+    sighash = bytes.fromhex("00" * 32)
+    false_sighash = bytes.fromhex("aa" * 32)
+    checks = [
+        (sighash, unlock_p2pkh(sighash, i), lock_p2pkh(pubkey_hash_from_prvkey(i)))
+        for i in range(1, 40)
+    ]
+    invalid_check = (false_sighash, checks[0][1], checks[0][2])
+    with ProcessPoolExecutor(2) as executor:
+        assert verify_scripts(checks, executor, batch_size=4)
+        assert not verify_scripts(checks + [invalid_check], executor, batch_size=4)
+    assert verify_scripts(checks)
+    assert not verify_scripts([invalid_check] + checks)
+
+
+def test_batch_verification():
+    sighash = bytes.fromhex("00" * 32)
+    false_sighash = bytes.fromhex("aa" * 32)
+    checks = [
+        (sighash, unlock_p2pk(sighash, i), lock_p2pk(pubkey_from_prvkey(i)))
+        for i in range(1, 10)
+    ]
+    invalid_check = (false_sighash, checks[0][1], checks[0][2])
+    assert verify_scripts(checks, batch_signatures=True)
+    assert not verify_scripts(checks + [invalid_check], batch_signatures=True)
+
+    signatures = []
+    for check in checks + [invalid_check]:
+        assert verify_script(check, signatures)  # deferred, optimistic
+    assert len(signatures) == 10
+    assert find_invalid_signatures(signatures) == [signatures[-1]]
+    assert find_invalid_signatures(signatures[:-1]) == []
+
+
+def test_batch_verification_not_verified():
+    # succeeds only if the signature is invalid, the checksig cannot be deferred
+    sighash = bytes.fromhex("00" * 32)
+    lock = Script(
+        [
+            [0x02, OP_PUSHDATA, b"\x00"],
+            [0x03, OP_SHNORR_CHECKSIG, b"\x00\x01"],
+            [0xFF, OP_EQUAL, b"\x02\x03"],
+            [0xFF, OP_VERIFY, b"\xff"],
+        ]
+    )
+    valid = (sighash, unlock_p2pk(sighash, 1), lock)
+    invalid = (bytes.fromhex("aa" * 32), unlock_p2pk(sighash, 1), lock)
+    signatures = []
+    assert not verify_script(valid, signatures)
+    assert verify_script(invalid, signatures)
+    assert signatures == []
+    assert verify_scripts([invalid], batch_signatures=True)
+
+
+def test_signature_cache():
+    sighash = bytes.fromhex("00" * 32)
+    check = (sighash, unlock_p2pk(sighash, 7), lock_p2pk(pubkey_from_prvkey(7)))
+    signature_cache.clear()
+    assert verify_script(check)
+    assert len(signature_cache) == 1
+    assert signature_cache.misses == 1
+    assert verify_script(check)
+    assert signature_cache.hits == 1
+
+    # invalid signatures are not cached
+    assert not verify_script((bytes.fromhex("aa" * 32), check[1], check[2]))
+    assert len(signature_cache) == 1
+
+
+def test_signature_cache_eviction():
+    cache = SignatureCache(max_size=8)
+    signatures = [(bytes([i]) * 32, b"\x01" * 32, b"\x02" * 64) for i in range(20)]
+    for signature in signatures:
+        cache.add(signature)
+    assert len(cache) == 8
+    assert sum(signature in cache for signature in signatures) == 8
+    assert signatures[-1] in cache
+    assert sorted(cache.entries.values()) == list(range(8))
+
+
+def test_compiled_script():
+    sighash = bytes.fromhex("00" * 32)
+    script = unlock_p2pkh(sighash, 1) + lock_p2pkh(pubkey_hash_from_prvkey(1))
+    compiled = compile_script(script)
+    assert compiled.execute({0x100: sighash})
+    assert not compiled.execute({0x100: bytes.fromhex("aa" * 32)})
+
+    # unknown opcodes and missing operands are rejected before execution
+    assert not compile_script(Script([[0, 0xFF, b""]])).execute({})
+    assert not compile_script(Script([[0, OP_EQUAL, b"\x00"]])).execute({})
+    assert compile_script(Script()).execute({})
+
+    # a signature check at the end of the unlocking script is still deferred
+    # when the OP_VERIFY is at the start of the locking script
+    unlocking = Script(script.expressions[:-1])
+    locking = Script(script.expressions[-1:])
+    signatures = []
+    compiled = compile_script(unlocking) + compile_script(locking)
+    assert compiled.execute({0x100: sighash}, signatures)
+    assert len(signatures) == 1
+
+
+def test_compiled_script_cache():
+    cache = CompiledScriptCache(max_size=2)
+    scripts = [lock_p2pkh(pubkey_hash_from_prvkey(i)) for i in range(1, 4)]
+    assert cache.get(scripts[0]) is cache.get(Script.from_hex(scripts[0].hex))
+    assert cache.hits == 1 and cache.misses == 1
+    cache.get(scripts[1])
+    cache.get(scripts[0])
+    cache.get(scripts[2])  # evicts scripts[1], the least recently used
+    assert len(cache) == 2
+    assert scripts[1].serialize() not in cache.scripts
+    assert scripts[0].serialize() in cache.scripts
+
+
+def test_template_fast_path():
+    sighash = bytes.fromhex("00" * 32)
+    false_sighash = bytes.fromhex("aa" * 32)
+    lockings = [
+        lock_p2pk(pubkey_from_prvkey(1)),
+        lock_p2pkh(pubkey_hash_from_prvkey(1)),
+    ]
+    for locking in lockings:
+        assert compiled_scripts.get(locking).template is not None
+    standard = unlock_p2pk(sighash, 1)
+    pubkey, sig = standard.expressions[0][2], standard.expressions[1][2]
+    unlockings = [
+        standard,
+        unlock_p2pk(sighash, 2),  # wrong key
+        Script([[0, OP_PUSHDATA, pubkey], [1, OP_PUSHDATA, sig[:-1] + b"\x00"]]),
+        Script([[0, OP_PUSHDATA, pubkey], [1, OP_PUSHDATA, b""]]),
+        Script([[1, OP_PUSHDATA, sig], [0, OP_PUSHDATA, pubkey]]),  # not standard
+        Script([[0, OP_PUSHDATA, pubkey]]),
+        Script(),
+    ]
+    # the fast path must agree with the interpreter, also on what it defers
+    for locking in lockings:
+        for unlocking in unlockings:
+            for msg in (sighash, false_sighash):
+                script = compile_script(unlocking + locking)
+                signature_cache.clear()
+                expected = script.execute({0x100: msg})
+                signature_cache.clear()
+                assert verify_script((msg, unlocking, locking)) == expected
+                expected_signatures, signatures = [], []
+                expected = script.execute({0x100: msg}, expected_signatures)
+                assert verify_script((msg, unlocking, locking), signatures) == expected
+                assert signatures == expected_signatures
+
+
+def test_non_standard_locking_script():
+    sighash = bytes.fromhex("00" * 32)
+    locking = lock_p2pk(pubkey_from_prvkey(1))
+    locking.expressions[0][0] = 0x04  # pushes the key to another variable
+    assert compiled_scripts.get(locking).template is None
+    assert not verify_script((sighash, unlock_p2pk(sighash, 1), locking))
+    locking = lock_p2pk(pubkey_from_prvkey(1)) + Script([[0, OP_PUSHDATA, b""]])
+    assert compiled_scripts.get(locking).template is None
+    assert verify_script((sighash, unlock_p2pk(sighash, 1), locking))
+
+
+def test_script_cost():
+    sighash = bytes.fromhex("00" * 32)
+    script = unlock_p2pkh(sighash, 1) + lock_p2pkh(pubkey_hash_from_prvkey(1))
+    # 3 pushes, the 64 bytes signature, hash, equal, checksig and 2 verify
+    assert script_cost(script) == (3 + 1 + 4 + 1 + 50 + 2, 1)
+    check = (sighash, unlock_p2pkh(sighash, 1), lock_p2pkh(pubkey_hash_from_prvkey(1)))
+    assert check_cost(check) == script_cost(script)
+
+    # hashing a variable costs according to its size
+    hashes = [[i % 2 + 1, OP_HASH256, b"\x00"] for i in range(10)]
+    small = Script([[0, OP_PUSHDATA, b"\x00" * 32]] + hashes)
+    large = Script([[0, OP_PUSHDATA, b"\x00" * 6400]] + hashes)
+    assert script_cost(small) == (1 + 10 * 4, 0)
+    assert script_cost(large) == (1 + 100 + 10 * (4 + 100), 0)
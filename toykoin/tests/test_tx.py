@@ -1,7 +1,10 @@
 import pytest
+from btclib import ssa
 
 from toykoin.core.tx import TxIn, TxOut, Tx, OutPoint
 from toykoin.core.script import Script
+from toykoin.core.sighash import sighash_all
+from toykoin.core.sign_tx import sign_tx, unlock_p2pkh
 
 
 def test_valid_serialization():
@@ -99,3 +102,87 @@ def test_invalid_coinbase():
         [TxOut(1, Script())],
     )
     assert not tx.is_valid()
+
+
+def test_deserialization_from_buffer():
+    tx_in = TxIn(OutPoint("ff" * 32, 0), Script.from_hex("00030000aa"))
+    tx_out = TxOut(10, Script.from_hex("00040001bbcc"))
+    tx = Tx([tx_in, TxIn(OutPoint("ee" * 32, 1), Script())], [tx_out, tx_out])
+    data = tx.serialize()
+    assert Tx.deserialize(memoryview(data)) == tx
+    assert Tx.deserialize(bytearray(data)) == tx
+    # the parsed scripts own their data, they do not keep the buffer alive
+    script_data = Tx.deserialize(memoryview(data)).inputs[0].unlocking_script
+    assert isinstance(script_data.expressions[0][2], bytes)
+
+
+def test_sealed_tx():
+    tx = Tx([TxIn(OutPoint("ff" * 32, 0), Script())], [TxOut(10, Script())])
+    txid = tx.txid
+    assert tx.seal().sealed
+    assert tx.txid == txid
+    assert Tx.deserialize(tx.serialize()) == tx
+
+    # assigning a field unseals the transaction
+    tx.outputs = [TxOut(20, Script())]
+    assert not tx.sealed
+    assert tx.txid != txid
+
+    # in place changes need an explicit unseal
+    tx.seal()
+    txid = tx.txid
+    tx.inputs[0].unlocking_script = Script.from_hex("00030000aa")
+    assert tx.txid == txid
+    assert tx.unseal().seal().txid != txid
+
+
+def test_compact_outpoint():
+    outpoint = OutPoint("ff" * 32, 1)
+    assert outpoint.hash == b"\xff" * 32
+    assert outpoint == OutPoint(b"\xff" * 32, 1)
+    assert len({outpoint, OutPoint(b"\xff" * 32, 1)}) == 1
+    assert len(outpoint.serialize()) == 34
+    assert outpoint.hex == "ff" * 32 + "0001"
+    assert OutPoint.deserialize(outpoint.serialize()) == outpoint
+
+    tx_in = TxIn(outpoint)
+    tx_out = TxOut(10)
+    for obj in (outpoint, tx_in, tx_out, tx_in.unlocking_script):
+        assert not hasattr(obj, "__dict__")
+    # every object gets its own script
+    assert tx_in.unlocking_script is not TxIn(outpoint).unlocking_script
+
+
+def test_sighash_all():
+    tx = Tx(
+        [
+            TxIn(OutPoint("ff" * 32, 0), Script.from_hex("00030000aa")),
+            TxIn(OutPoint("ee" * 32, 1), Script.from_hex("00030000bb")),
+        ],
+        [TxOut(10, Script.from_hex("00030000cc"))],
+    )
+    stripped = Tx(
+        [TxIn(OutPoint("ff" * 32, 0)), TxIn(OutPoint("ee" * 32, 1))], tx.outputs
+    )
+    txid = tx.txid
+    assert sighash_all(tx) == stripped.hash
+    assert tx.txid == txid  # the unlocking scripts are left untouched
+
+    tx.seal()
+    assert sighash_all(tx) == stripped.hash
+    assert tx._cache["sighash_all"] == stripped.hash
+
+
+def test_sign_tx():
+    tx = Tx([TxIn(OutPoint("ff" * 32, 0)), TxIn(OutPoint("ee" * 32, 1))], [TxOut(10)])
+    sighash = sighash_all(tx)
+    txid = tx.seal().txid
+    sign_tx(tx, [1, 2])
+    assert not tx.sealed and tx.txid != txid
+    assert sighash_all(tx) == sighash
+    for tx_in, prvkey in zip(tx.inputs, [1, 2]):
+        pubkey, sig = [
+            expression[2] for expression in tx_in.unlocking_script.expressions
+        ]
+        assert pubkey == unlock_p2pkh(sighash, prvkey).expressions[0][2]
+        assert ssa._verify(sighash, pubkey, sig)
@@ -1,5 +1,58 @@
-from toykoin.core.utils import generate_merkle_root
+from toykoin.core.utils import (
+    generate_merkle_root,
+    MerkleTree,
+    verify_merkle_proof,
+    hash256,
+)
 
 
 def test_merkle_root():
     assert generate_merkle_root([])
+
+
+# the root computed level by level from scratch
+def merkle_root(hashes):
+    hashes = list(hashes)
+    while len(hashes) > 1:
+        if len(hashes) % 2:
+            hashes.append(hashes[-1])
+        hashes = [hash256(hashes[i] + hashes[i + 1]) for i in range(0, len(hashes), 2)]
+    return hashes[0]
+
+
+def test_merkle_tree_append():
+    leaves = [hash256(bytes([i])) for i in range(20)]
+    tree = MerkleTree()
+    assert tree.root == hash256(b"")
+    for i, leaf in enumerate(leaves):
+        tree.append(leaf)
+        assert tree.root == merkle_root(leaves[: i + 1])
+    assert MerkleTree(leaves).root == tree.root
+
+    tree[0] = hash256(b"coinbase")
+    assert tree.root == merkle_root([hash256(b"coinbase")] + leaves[1:])
+
+
+def test_merkle_tree_update_is_incremental(monkeypatch):
+    import toykoin.core.utils
+
+    leaves = [hash256(bytes([i])) for i in range(16)]
+    tree = MerkleTree(leaves)
+    tree.root
+    calls = []
+    monkeypatch.setattr(
+        toykoin.core.utils, "hash256", lambda data: calls.append(data) or hash256(data)
+    )
+    tree[5] = hash256(b"new")
+    tree.root
+    assert len(calls) == 4  # one node for each level above the leaves
+
+
+def test_merkle_proof():
+    for n in range(1, 12):
+        leaves = [hash256(bytes([i])) for i in range(n)]
+        tree = MerkleTree(leaves)
+        for i, leaf in enumerate(leaves):
+            proof = tree.proof(i)
+            assert verify_merkle_proof(leaf, i, proof, tree.root)
+            assert not verify_merkle_proof(hash256(b"other"), i, proof, tree.root)
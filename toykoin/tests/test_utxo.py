@@ -1,10 +1,13 @@
-from toykoin.core.utxo import UTXOSet
+from toykoin.core.utxo import UTXOSet, UTXOCache, UTXO_ENTRY_SIZE
 from toykoin.core.tx import Tx, TxIn, TxOut, OutPoint
 from toykoin.core.script import Script
-from toykoin.core.block import RevBlock
+from toykoin.core.block import Block, BlockHeader, RevBlock
+from toykoin.core.utils import generate_merkle_root, hash256, get_schema_version
+import toykoin.core.tx
 
 import pytest
 import os
+import sqlite3
 
 
 def test_invalid_tx():
@@ -22,9 +25,9 @@ def test_invalid_tx():
 
 def test_invalid_rev_block_1():
     utxo_set = UTXOSet()
-    rev_block = RevBlock("", [], [])
-    rev_block.pow = "00" * 32
-    rev_block.old_txout = [[OutPoint("ff" * 32, 0).hex, TxOut(-1)]]
+    rev_block = RevBlock(b"", [], [])
+    rev_block.pow = b"\x00" * 32
+    rev_block.old_txout = [[OutPoint("ff" * 32, 0).serialize(), TxOut(-1)]]
     with pytest.raises(Exception):
         utxo_set.reverse_block(rev_block)
     os.remove("utxo_set.sqlite")
@@ -32,9 +35,9 @@ def test_invalid_rev_block_1():
 
 def test_invalid_rev_block_2():
     utxo_set = UTXOSet()
-    rev_block = RevBlock("", [], [])
-    rev_block.pow = "00" * 32
-    rev_block.old_txout = [[OutPoint("00" * 32, 0).hex, TxOut()]]
+    rev_block = RevBlock(b"", [], [])
+    rev_block.pow = b"\x00" * 32
+    rev_block.old_txout = [[OutPoint("00" * 32, 0).serialize(), TxOut()]]
     with pytest.raises(Exception):
         utxo_set.reverse_block(rev_block)
     os.remove("utxo_set.sqlite")
@@ -42,9 +45,148 @@ def test_invalid_rev_block_2():
 
 def test_invalid_rev_block_3():
     utxo_set = UTXOSet()
-    rev_block = RevBlock("", [], [])
-    rev_block.pow = "00" * 32
-    rev_block.removable = [OutPoint("aa" * 32, 0).hex]
+    rev_block = RevBlock(b"", [], [])
+    rev_block.pow = b"\x00" * 32
+    rev_block.removable = [OutPoint("aa" * 32, 0).serialize()]
     with pytest.raises(Exception):
         utxo_set.reverse_block(rev_block)
     os.remove("utxo_set.sqlite")
+
+
+def test_add_block_hashes_once(monkeypatch):
+    utxo_set = UTXOSet()
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10 ** 10, Script())]
+    )
+    origin = Block(
+        BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0), [coinbase_0]
+    )
+    utxo_set.add_block(origin)
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    tx = Tx(
+        [TxIn(OutPoint(coinbase_0.txid, 0), Script.from_hex("00030000bb"))],
+        [TxOut(10 ** 5, Script()), TxOut(10 ** 5, Script())],
+    )
+    transactions = [coinbase_1, tx]
+    block_1 = Block(
+        BlockHeader(origin.header.pow, generate_merkle_root(transactions), 0),
+        transactions,
+    )
+
+    hashed = []
+
+    def counting_hash256(data):
+        hashed.append(bytes(data))
+        return hash256(data)
+
+    monkeypatch.setattr(toykoin.core.tx, "hash256", counting_hash256)
+    utxo_set.add_block(block_1)
+    assert hashed.count(coinbase_1.serialize()) == 1
+    assert hashed.count(tx.serialize()) == 1
+    os.remove("utxo_set.sqlite")
+
+
+def test_schema_migration():
+    db = sqlite3.connect("utxo_set.sqlite")
+    db.execute("CREATE TABLE utxo (id, value, script)")
+    db.execute("INSERT INTO utxo VALUES (?, ?, ?)", ("aa" * 34, 10, b""))
+    db.commit()
+    db.close()
+
+    utxo_set = UTXOSet()
+    assert utxo_set.get_utxo(b"\xaa" * 34) == TxOut(10, Script())
+    assert get_schema_version(utxo_set.cursor, "utxo") == 1
+    utxo_set.cursor.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM utxo WHERE id = ?", (b"",)
+    )
+    assert "PRIMARY KEY" in utxo_set.cursor.fetchall()[0][-1]
+
+    utxo_set = UTXOSet()  # already migrated
+    assert utxo_set.get_utxo_list() == [(b"\xaa" * 34,)]
+    os.remove("utxo_set.sqlite")
+
+
+def test_utxo_cache():
+    utxo_set = UTXOSet(cache_size=0)
+    id_1 = OutPoint("aa" * 32, 0).serialize()
+    id_2 = OutPoint("bb" * 32, 0).serialize()
+    utxo_set.add_utxo(id_1, TxOut(1))
+    utxo_set.add_utxo(id_2, TxOut(2))
+    utxo_set.remove_utxo(id_2)  # created and spent before the flush
+    assert utxo_set.get_utxo_list() == [(id_1,)]
+    utxo_set.cursor.execute("SELECT id FROM utxo")
+    assert utxo_set.cursor.fetchall() == []  # nothing written yet
+    utxo_set.commit()
+    utxo_set.cursor.execute("SELECT id FROM utxo")
+    assert utxo_set.cursor.fetchall() == [(id_1,)]
+    assert not utxo_set.cache.clean  # evicted, the budget is zero
+
+    utxo_set.remove_utxo(id_1)
+    assert not utxo_set.get_utxo(id_1)
+    utxo_set.rollback()
+    assert utxo_set.get_utxo(id_1) == TxOut(1)
+    utxo_set.remove_utxo(id_1)
+    utxo_set.commit()
+    assert utxo_set.get_utxo_list() == []
+    assert UTXOSet().get_utxo_list() == []
+    os.remove("utxo_set.sqlite")
+
+
+def test_utxo_cache_eviction():
+    utxo_set = UTXOSet()
+    ids = [OutPoint("aa" * 32, i).serialize() for i in range(10)]
+    for id in ids:
+        utxo_set.add_utxo(id, TxOut(1))
+    utxo_set.commit()
+    utxo_set.cache = UTXOCache(utxo_set.cursor, 3 * UTXO_ENTRY_SIZE)
+    for id in ids:
+        assert utxo_set.get_utxo(id) == TxOut(1)
+    assert list(utxo_set.cache.clean) == ids[-3:]
+    assert utxo_set.get_utxo(ids[-3])
+    utxo_set.get_utxo(ids[0])
+    assert list(utxo_set.cache.clean) == [ids[-1], ids[-3], ids[0]]
+    os.remove("utxo_set.sqlite")
+
+
+def test_block_prefetch():
+    utxo_set = UTXOSet(cache_size=0)
+    coinbase_0 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script())], [TxOut(10, Script())] * 1200
+    )
+    origin = Block(
+        BlockHeader("00" * 32, generate_merkle_root([coinbase_0]), 0), [coinbase_0]
+    )
+    utxo_set.add_block(origin)
+    utxo_set.commit()
+
+    coinbase_1 = Tx(
+        [TxIn(OutPoint("00" * 32, 0), Script.from_hex("00030000aa"))],
+        [TxOut(10 ** 10, Script())],
+    )
+    tx = Tx(
+        [TxIn(OutPoint(coinbase_0.txid, i)) for i in range(1200)],
+        [TxOut(12000, Script())],
+    )
+    transactions = [coinbase_1, tx]
+    block_1 = Block(
+        BlockHeader(origin.header.pow, generate_merkle_root(transactions), 0),
+        transactions,
+    )
+    queries = []
+    utxo_set.db.set_trace_callback(queries.append)
+    rev_block = utxo_set.add_block(block_1)
+    assert len(rev_block.old_txout) == 1200
+    assert len([query for query in queries if query.startswith("SELECT")]) == 3
+    os.remove("utxo_set.sqlite")
+
+
+def test_durability_profile():
+    utxo_set = UTXOSet(profile="ibd")
+    assert utxo_set.db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert utxo_set.db.execute("PRAGMA synchronous").fetchone() == (0,)
+    utxo_set.close()
+    os.remove("utxo_set.sqlite")